@@ -4,11 +4,21 @@
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import altair as alt
 import re
+import os
+import sys
+import time
 import uuid
+import argparse
+import html
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from difflib import SequenceMatcher
 
+from lab_units import canonicalize, match_csv_layout
+
 # =========================================================
 # 1) CONFIG
 # =========================================================
@@ -41,11 +51,32 @@ if "active_patient" not in st.session_state:
     st.session_state["active_patient"] = list(st.session_state["patients"].keys())[0]
 
 if "data" not in st.session_state:
-    st.session_state["data"] = pd.DataFrame(columns=["PatientID", "Date", "Marker", "Value", "Unit"])
+    st.session_state["data"] = pd.DataFrame(
+        columns=["PatientID", "Date", "Marker", "Value", "Unit", "CanonicalValue", "CanonicalUnit"]
+    )
 
 if "events" not in st.session_state:
     st.session_state["events"] = pd.DataFrame(columns=["PatientID", "Date", "Event", "Type", "Notes"])
 
+# (PatientID, CleanMarker) -> latest/previous value + status, maintained as rows are appended
+if "latest" not in st.session_state:
+    st.session_state["latest"] = {}
+
+# PatientID -> most recent lab date
+if "last_lab" not in st.session_state:
+    st.session_state["last_lab"] = {}
+
+# Bumped on every results mutation; clinic-wide aggregates are cached against it
+if "data_version" not in st.session_state:
+    st.session_state["data_version"] = 0
+
+if "derived" not in st.session_state:
+    st.session_state["derived"] = {}
+
+# Raw marker name -> master row label (master ranges are static, so this never expires)
+if "marker_match" not in st.session_state:
+    st.session_state["marker_match"] = {}
+
 if "ui" not in st.session_state:
     st.session_state["ui"] = {
         "nav": "Consult",
@@ -83,10 +114,24 @@ def add_patient(name, sex="M", age=0, mrn="", height_cm="", weight_kg="", notes=
 def update_patient(pid, **kwargs):
     if pid in st.session_state["patients"]:
         st.session_state["patients"][pid].update(kwargs)
+        bump_data_version()  # cohort strata depend on sex / age
+
+def bump_data_version():
+    st.session_state["data_version"] += 1
+
+def cached_by_data_version(name, build):
+    hit = st.session_state["derived"].get(name)
+    if hit is not None and hit[0] == st.session_state["data_version"]:
+        return hit[1]
+    value = build()
+    st.session_state["derived"][name] = (st.session_state["data_version"], value)
+    return value
 
 def delete_patient(pid):
     if pid in st.session_state["patients"]:
         del st.session_state["patients"][pid]
+        drop_latest_view(pid)
+        bump_data_version()
         st.session_state["data"] = st.session_state["data"][
             st.session_state["data"]["PatientID"] != pid
         ].reset_index(drop=True)
@@ -507,27 +552,35 @@ div[data-testid="stForm"] > div { gap: 0.55rem !important; }
 # =========================================================
 # 5) DATA LOGIC
 # =========================================================
-def clean_numeric_value(val):
-    if pd.isna(val) or str(val).strip() == "":
-        return None
-    s = str(val).strip().replace(",", "").replace(" ", "")
-    s = s.replace("µ", "u")  # keep this one safe
-    s = s.replace("ug/L", "").replace("ug/dL", "").replace("ng/mL", "").replace("mg/dL", "")
-    s = s.replace("mIU/L", "").replace("uIU/mL", "").replace("nmol/L", "").replace("%", "")
-    s = s.replace("<", "").replace(">", "")
-    match = re.search(r"[-+]?\d*\.\d+|\d+", s)
-    if match:
-        try:
-            return float(match.group())
-        except Exception:
-            return None
-    return None
-
 def clean_marker_name(val):
     if pd.isna(val):
         return ""
     return re.sub(r"^[SPBU]-\s*", "", str(val).upper().strip())
 
+def apply_unit_conversions(df, master):
+    """
+    Adds CanonicalValue / CanonicalUnit (master units) alongside the raw Value / Unit.
+    Values with no unit, an already-canonical unit, or no table entry are kept as-is.
+    """
+    out = df.copy()
+    if out.empty:
+        out["CanonicalValue"] = pd.Series(dtype="float64")
+        out["CanonicalUnit"] = pd.Series(dtype="object")
+        return out
+
+    # One fuzzy match per distinct marker name, not per row
+    biomarker_map, target_map = {}, {}
+    for m in out["Marker"].dropna().unique():
+        m_row = fuzzy_match(m, master)
+        if m_row is not None:
+            biomarker_map[m] = m_row["Biomarker"]
+            target_map[m] = m_row["Unit"] if pd.notna(m_row["Unit"]) else ""
+    units = out["Unit"] if "Unit" in out.columns else pd.Series("", index=out.index)
+    out["CanonicalValue"], out["CanonicalUnit"] = canonicalize(
+        out["Value"], units, out["Marker"].map(biomarker_map), out["Marker"].map(target_map)
+    )
+    return out
+
 def parse_flexible_date(date_str):
     if pd.isna(date_str) or str(date_str).strip() == "":
         return pd.NaT
@@ -539,9 +592,9 @@ def parse_flexible_date(date_str):
             continue
     return pd.to_datetime(date_str, errors="coerce")
 
-def get_patient_data(patient_id):
-    all_results = st.session_state["data"].copy()
-    all_events = st.session_state["events"].copy()
+def get_patient_data(patient_id, all_results=None, all_events=None):
+    all_results = (st.session_state["data"] if all_results is None else all_results).copy()
+    all_events = (st.session_state["events"] if all_events is None else all_events).copy()
 
     results = all_results[all_results["PatientID"] == patient_id].copy() if not all_results.empty else all_results
     events = all_events[all_events["PatientID"] == patient_id].copy() if not all_events.empty else all_events
@@ -549,7 +602,7 @@ def get_patient_data(patient_id):
     if not results.empty:
         results["Date"] = results["Date"].apply(parse_flexible_date)
         results["CleanMarker"] = results["Marker"].apply(clean_marker_name)
-        results["NumericValue"] = results["Value"].apply(clean_numeric_value)
+        results["NumericValue"] = pd.to_numeric(results["CanonicalValue"], errors="coerce")
         results["Fingerprint"] = (
             results["Date"].astype(str) + "_" + results["CleanMarker"] + "_" + results["NumericValue"].astype(str)
         )
@@ -560,6 +613,77 @@ def get_patient_data(patient_id):
 
     return results, events
 
+def update_latest_view(new_rows):
+    """
+    Fold freshly appended rows into the (PatientID, CleanMarker) latest-value view so
+    "latest / previous value of X for P" lookups never rescan the results store.
+    """
+    if new_rows.empty:
+        return
+    view = st.session_state["latest"]
+    last_lab = st.session_state["last_lab"]
+
+    rows = pd.DataFrame(
+        {
+            "PatientID": new_rows["PatientID"],
+            "Date": new_rows["Date"].apply(parse_flexible_date),
+            "CleanMarker": new_rows["Marker"].apply(clean_marker_name),
+            "NumericValue": pd.to_numeric(new_rows["CanonicalValue"], errors="coerce"),
+        }
+    )
+    rows = rows.dropna(subset=["Date"]).sort_values("Date", kind="stable")
+
+    touched = set()
+    for p_id, d, marker, v in rows.itertuples(index=False):
+        key = (p_id, marker)
+        entry = view.get(key)
+        if entry is None:
+            view[key] = {"latest_date": d, "latest_value": v, "prev_date": None, "prev_value": None, "status": None}
+        elif d > entry["latest_date"]:
+            entry["prev_date"], entry["prev_value"] = entry["latest_date"], entry["latest_value"]
+            entry["latest_date"], entry["latest_value"] = d, v
+        elif d == entry["latest_date"]:
+            entry["latest_value"] = v
+        elif entry["prev_date"] is None or d >= entry["prev_date"]:
+            entry["prev_date"], entry["prev_value"] = d, v
+        touched.add(key)
+        if p_id not in last_lab or d > last_lab[p_id]:
+            last_lab[p_id] = d
+
+    master_df = get_master_data()
+    m_rows = {}
+    for key in touched:
+        entry = view[key]
+        marker = key[1]
+        if marker not in m_rows:
+            m_rows[marker] = fuzzy_match(marker, master_df)
+        m_row = m_rows[marker]
+        if m_row is None or pd.isna(entry["latest_value"]):
+            entry["status"] = None
+        else:
+            entry["status"] = get_status(entry["latest_value"], m_row)[:2]
+
+def drop_latest_view(patient_id):
+    view = st.session_state["latest"]
+    for key in [k for k in view if k[0] == patient_id]:
+        del view[key]
+    st.session_state["last_lab"].pop(patient_id, None)
+
+def get_latest(patient_id, marker_clean):
+    return st.session_state["latest"].get((patient_id, marker_clean))
+
+# --- Upload layouts ---
+# Known CSV layouts are mapped column-for-column before the substring heuristics in process_upload get a
+# look; those heuristics misfire on exports with extra columns ("Patient Name" -> Marker, "Result Units"
+# -> Value) and cannot read one-row-per-date tables at all. Fingerprints only look at the header; the
+# layouts themselves are shared with the dashboard (lab_units.CSV_LAYOUTS).
+def match_upload_layout(df):
+    """(layout name, Date/Marker/Value/Unit frame) for a known layout, else None."""
+    layout = match_csv_layout([str(c).strip().lower() for c in df.columns])
+    if layout is None:
+        return None
+    return layout["name"], layout["parse"](df)[["Date", "Marker", "Value", "Unit"]]
+
 def process_upload(uploaded_file, patient_id, show_debug=False):
     try:
         try:
@@ -572,30 +696,37 @@ def process_upload(uploaded_file, patient_id, show_debug=False):
             with st.expander("Debug: raw upload preview", expanded=False):
                 st.dataframe(df_new.head())
 
-        df_new.columns = df_new.columns.str.strip().str.lower()
-        rename_dict = {}
-        for c in df_new.columns:
-            if any(x in c for x in ["marker", "biomarker", "test", "name", "analyte"]):
-                rename_dict[c] = "Marker"
-            elif any(x in c for x in ["result", "reading", "value", "concentration"]):
-                rename_dict[c] = "Value"
-            elif any(x in c for x in ["time", "collected", "date"]):
-                rename_dict[c] = "Date"
-            elif "unit" in c:
-                rename_dict[c] = "Unit"
-
-        df_new = df_new.rename(columns=rename_dict)
-        needed = ["Date", "Marker", "Value"]
-        missing = [x for x in needed if x not in df_new.columns]
-        if missing:
-            return f"Missing columns: {missing}. Found: {df_new.columns.tolist()}", 0
-
-        if "Unit" not in df_new.columns:
-            df_new["Unit"] = ""
-
-        df_new = df_new[needed + ["Unit"]]
+        layout = match_upload_layout(df_new)
+        if layout is not None:
+            df_new = layout[1]
+        else:
+            df_new.columns = df_new.columns.str.strip().str.lower()
+            rename_dict = {}
+            for c in df_new.columns:
+                if any(x in c for x in ["marker", "biomarker", "test", "name", "analyte"]):
+                    rename_dict[c] = "Marker"
+                elif any(x in c for x in ["result", "reading", "value", "concentration"]):
+                    rename_dict[c] = "Value"
+                elif any(x in c for x in ["time", "collected", "date"]):
+                    rename_dict[c] = "Date"
+                elif "unit" in c:
+                    rename_dict[c] = "Unit"
+
+            df_new = df_new.rename(columns=rename_dict)
+            needed = ["Date", "Marker", "Value"]
+            missing = [x for x in needed if x not in df_new.columns]
+            if missing:
+                return f"Missing columns: {missing}. Found: {df_new.columns.tolist()}", 0
+
+            if "Unit" not in df_new.columns:
+                df_new["Unit"] = ""
+
+            df_new = df_new[needed + ["Unit"]]
+        df_new = apply_unit_conversions(df_new, get_master_data())
         df_new["PatientID"] = patient_id
         st.session_state["data"] = pd.concat([st.session_state["data"], df_new], ignore_index=True)
+        update_latest_view(df_new)
+        bump_data_version()
         return "Success", len(df_new)
 
     except Exception as e:
@@ -617,6 +748,8 @@ def delete_event(index):
     st.session_state["events"] = st.session_state["events"].drop(index).reset_index(drop=True)
 
 def wipe_patient_data(patient_id):
+    drop_latest_view(patient_id)
+    bump_data_version()
     st.session_state["data"] = st.session_state["data"][
         st.session_state["data"]["PatientID"] != patient_id
     ].reset_index(drop=True)
@@ -757,12 +890,18 @@ def get_status(val, master_row):
 def status_chip(status_key: str, label: str) -> str:
     return f'<span class="chip {status_key}">{label}</span>'
 
-def last_lab_date(results_df):
-    if results_df.empty or results_df["Date"].dropna().empty:
-        return None
-    return results_df["Date"].dropna().max()
+def last_lab_date(patient_id):
+    return st.session_state["last_lab"].get(patient_id)
+
+def calc_delta(marker_clean, results, current_date, patient_id=None):
+    entry = get_latest(patient_id, marker_clean) if patient_id is not None else None
+    if entry is not None and entry["latest_date"] == current_date:
+        prev_val, cur_val = entry["prev_value"], entry["latest_value"]
+        if prev_val is None or pd.isna(prev_val) or pd.isna(cur_val):
+            return None
+        return cur_val - prev_val
 
-def calc_delta(marker_clean, results, current_date):
+    # Older report selected: fall back to scanning this marker's history
     df = results[(results["CleanMarker"] == marker_clean) & results["Date"].notna()].copy()
     df = df.sort_values("Date")
     cur = df[df["Date"] == current_date]
@@ -777,6 +916,208 @@ def calc_delta(marker_clean, results, current_date):
         return None
     return cur_val - prev_val
 
+def build_dashboard_rows(results_df, master_df, sel_date, use_latest_view=True):
+    subset = results_df[results_df["Date"] == sel_date].copy()
+    rows = []
+    counts = {"bad": 0, "warn": 0, "ok": 0, "optimal": 0}
+
+    for _, r in subset.iterrows():
+        m_row = fuzzy_match(r["Marker"], master_df)
+        if m_row is None or pd.isna(r["NumericValue"]):
+            continue
+
+        status_label, status_key, prio = get_status(r["NumericValue"], m_row)
+        counts[status_key] = counts.get(status_key, 0) + 1
+
+        s_min, s_max = parse_range(m_row["Standard Range"])
+        unit = m_row["Unit"] if pd.notna(m_row["Unit"]) else (r.get("Unit", "") or "")
+        delta = calc_delta(
+            r["CleanMarker"], results_df, sel_date, patient_id=r["PatientID"] if use_latest_view else None
+        )
+
+        ref_str = ""
+        if s_min is not None and s_max is not None:
+            ref_str = f"{s_min:g}-{s_max:g} {unit}".strip()
+
+        rows.append(
+            {
+                "Marker": m_row["Biomarker"],
+                "MarkerClean": r["CleanMarker"],
+                "Value": r["NumericValue"],
+                "Unit": unit,
+                "StatusLabel": status_label,
+                "StatusKey": status_key,
+                "Prio": prio,
+                "Ref": ref_str,
+                "Delta": delta,
+            }
+        )
+
+    return rows, counts
+
+def master_bounds(master_df):
+    """Standard / optimal bounds per master row, parsed the same way get_status does."""
+    def _float_or_none(x):
+        try:
+            return float(x) if x is not None and str(x).strip() != "" else None
+        except Exception:
+            return None
+
+    bounds = master_df[["Biomarker", "Unit"]].copy()
+    parsed = master_df["Standard Range"].apply(parse_range)
+    bounds["SMin"] = pd.to_numeric(parsed.str[0], errors="coerce")
+    bounds["SMax"] = pd.to_numeric(parsed.str[1], errors="coerce")
+    bounds["OMin"] = pd.to_numeric(master_df["Optimal Min"].apply(_float_or_none), errors="coerce")
+    bounds["OMax"] = pd.to_numeric(master_df["Optimal Max"].apply(_float_or_none), errors="coerce")
+    return bounds
+
+def match_master_labels(markers, master_df):
+    """Master row label per marker name; each distinct name is fuzzy-matched once per session."""
+    memo = st.session_state["marker_match"]
+    for m in markers:
+        if m not in memo:
+            m_row = fuzzy_match(m, master_df)
+            memo[m] = m_row.name if m_row is not None else None
+    return {m: memo[m] for m in markers}
+
+STATUS_LABELS = {"bad": "OUT OF RANGE", "optimal": "OPTIMAL", "warn": "BORDERLINE", "ok": "IN RANGE"}
+STATUS_PRIO = {"bad": 1, "warn": 2, "ok": 3, "optimal": 4}
+
+def classify_latest_values(data, master_df):
+    """
+    Latest numeric value per (PatientID, CleanMarker) across the whole store, classified
+    with the get_status rules in one vectorized pass. Unmatched markers are dropped.
+    """
+    cols = ["PatientID", "CleanMarker", "Biomarker", "Date", "Value", "Unit", "StatusKey", "StatusLabel", "Prio"]
+    if data.empty:
+        return pd.DataFrame(columns=cols)
+
+    df = pd.DataFrame({"PatientID": data["PatientID"]})
+    df["Date"] = data["Date"].map({d: parse_flexible_date(d) for d in data["Date"].unique()})
+    df["CleanMarker"] = data["Marker"].map({m: clean_marker_name(m) for m in data["Marker"].unique()})
+    df["Value"] = pd.to_numeric(data["CanonicalValue"], errors="coerce")
+    df = df.dropna(subset=["Date", "Value"])
+    df = df.sort_values("Date", kind="stable").drop_duplicates(subset=["PatientID", "CleanMarker"], keep="last")
+
+    labels = match_master_labels(df["CleanMarker"].unique(), master_df)
+    df["MasterRow"] = df["CleanMarker"].map(labels)
+    df = df.dropna(subset=["MasterRow"])
+    df = df.join(master_bounds(master_df), on="MasterRow")
+
+    v = df["Value"]
+    has_standard = df["SMin"].notna() & df["SMax"].notna()
+    has_optimal = df["OMin"].notna() & df["OMax"].notna()
+    bad = has_standard & ((v < df["SMin"]) | (v > df["SMax"]))
+    optimal = ~bad & has_optimal & (v >= df["OMin"]) & (v <= df["OMax"])
+    warn = ~bad & has_optimal & ~optimal
+
+    df["StatusKey"] = np.select([bad, optimal, warn], ["bad", "optimal", "warn"], default="ok")
+    df["StatusLabel"] = df["StatusKey"].map(STATUS_LABELS)
+    df["Prio"] = df["StatusKey"].map(STATUS_PRIO)
+    return df[cols].reset_index(drop=True)
+
+def latest_classified():
+    return cached_by_data_version(
+        "latest_classified", lambda: classify_latest_values(st.session_state["data"], get_master_data())
+    )
+
+def build_worklist():
+    """Patients ranked by out-of-range, then borderline counts on their latest values."""
+    def _build():
+        lat = latest_classified()
+        if lat.empty:
+            return pd.DataFrame(columns=["PatientID", "bad", "warn", "ok", "optimal", "LastDate", "Flagged"])
+        counts = pd.crosstab(lat["PatientID"], lat["StatusKey"]).rename_axis(columns=None)
+        for key in ["bad", "warn", "ok", "optimal"]:
+            if key not in counts.columns:
+                counts[key] = 0
+        wl = counts[["bad", "warn", "ok", "optimal"]].copy()
+        wl["LastDate"] = lat.groupby("PatientID")["Date"].max()
+        flagged = lat[lat["StatusKey"].isin(["bad", "warn"])].sort_values(["Prio", "Biomarker"])
+        wl["Flagged"] = flagged.groupby("PatientID")["Biomarker"].agg(lambda s: ", ".join(s.head(4)))
+        wl["Flagged"] = wl["Flagged"].fillna("")
+        wl = wl.sort_values(["bad", "warn", "LastDate"], ascending=[False, False, False])
+        return wl.reset_index()
+
+    return cached_by_data_version("worklist", _build)
+
+AGE_BANDS = [(0, 29, "<30"), (30, 39, "30-39"), (40, 49, "40-49"), (50, 59, "50-59"), (60, 69, "60-69"), (70, 200, "70+")]
+COHORT_PERCENTILES = [0.10, 0.25, 0.50, 0.75, 0.90]
+COHORT_BINS = 20
+
+def age_band(age):
+    try:
+        a = int(float(age))
+    except Exception:
+        return "Unknown"
+    for lo, hi, label in AGE_BANDS:
+        if lo <= a <= hi:
+            return label
+    return "Unknown"
+
+def cohort_frame():
+    """Latest classified values joined with patient sex / age band, plus each patient's clinic percentile."""
+    def _build():
+        lat = latest_classified().copy()
+        patients = st.session_state["patients"]
+        lat["Sex"] = lat["PatientID"].map(lambda p: patients.get(p, {}).get("sex", "") or "Unknown")
+        lat["AgeBand"] = lat["PatientID"].map(lambda p: age_band(patients.get(p, {}).get("age", "")))
+        lat["ClinicPct"] = lat.groupby("Biomarker")["Value"].rank(pct=True) * 100
+        return lat
+
+    return cached_by_data_version("cohort_frame", _build)
+
+def clinic_percentiles():
+    """(PatientID, CleanMarker) -> percentile of that patient's latest value among all patients."""
+    def _build():
+        cf = cohort_frame()
+        return dict(zip(zip(cf["PatientID"], cf["CleanMarker"]), cf["ClinicPct"]))
+
+    return cached_by_data_version("clinic_pct", _build)
+
+def cohort_stats(stratify=None):
+    """
+    Per-biomarker distribution of latest values: patient count, percentiles and status counts.
+    stratify: None, "Sex", "AgeBand" or ["Sex", "AgeBand"].
+    """
+    strata = [] if stratify is None else ([stratify] if isinstance(stratify, str) else list(stratify))
+
+    def _build():
+        cf = cohort_frame()
+        keys = ["Biomarker"] + strata
+        if cf.empty:
+            return pd.DataFrame(columns=keys + ["Patients"])
+        grouped = cf.groupby(keys)
+        stats = grouped["Value"].quantile(COHORT_PERCENTILES).unstack()
+        stats.columns = [f"P{int(q * 100)}" for q in stats.columns]
+        stats.insert(0, "Patients", grouped["Value"].size())
+        status = grouped["StatusKey"].value_counts().unstack(fill_value=0)
+        for key in ["bad", "warn", "ok", "optimal"]:
+            stats[STATUS_LABELS[key]] = status[key] if key in status.columns else 0
+        return stats.reset_index()
+
+    return cached_by_data_version(f"cohort_stats_{'_'.join(strata)}", _build)
+
+def cohort_histograms():
+    """Pre-aggregated histogram bins per biomarker (COHORT_BINS equal-width bins over its range)."""
+    def _build():
+        cf = cohort_frame()
+        cols = ["Biomarker", "BinStart", "BinEnd", "Patients"]
+        if cf.empty:
+            return pd.DataFrame(columns=cols)
+        lo = cf.groupby("Biomarker")["Value"].transform("min")
+        hi = cf.groupby("Biomarker")["Value"].transform("max")
+        width = ((hi - lo) / COHORT_BINS).where(hi > lo, 1.0)
+        idx = ((cf["Value"] - lo) / width).floordiv(1).clip(0, COHORT_BINS - 1).astype(int)
+        bins = pd.DataFrame({"Biomarker": cf["Biomarker"], "Bin": idx, "Lo": lo, "Width": width})
+        hist = bins.groupby(["Biomarker", "Bin"]).agg(Patients=("Bin", "size"), Lo=("Lo", "first"), Width=("Width", "first"))
+        hist = hist.reset_index()
+        hist["BinStart"] = hist["Lo"] + hist["Bin"] * hist["Width"]
+        hist["BinEnd"] = hist["BinStart"] + hist["Width"]
+        return hist[cols]
+
+    return cached_by_data_version("cohort_hist", _build)
+
 # =========================================================
 # 8) CHART ENGINE
 # =========================================================
@@ -932,6 +1273,157 @@ def plot_chart(marker, results, events, master):
 
     return alt.layer(*layers).properties(height=420, background="#FFFFFF").configure_view(strokeWidth=0)
 
+# =========================================================
+# 8b) HEADLESS BATCH REPORTS
+#     python clinical.py --results results.csv [--patients patients.csv] [--events events.csv] --out reports/
+# =========================================================
+_BATCH = {}
+
+def _read_store_csv(path, columns):
+    if not path:
+        return pd.DataFrame(columns=columns)
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    for c in columns:
+        if c not in df.columns:
+            df[c] = ""
+    return df
+
+def load_patient_store(results_path, patients_path=None, events_path=None):
+    """Loads CSV exports shaped like st.session_state data / events / patients."""
+    results = _read_store_csv(results_path, ["PatientID", "Date", "Marker", "Value", "Unit"])
+    events = _read_store_csv(events_path, ["PatientID", "Date", "Event", "Type", "Notes"])
+    if "CanonicalValue" not in results.columns or (results["CanonicalValue"] == "").all():
+        results = apply_unit_conversions(results.drop(columns=["CanonicalValue", "CanonicalUnit"], errors="ignore"), get_master_data())
+
+    patients = {}
+    if patients_path:
+        for p in _read_store_csv(patients_path, ["id", "name", "sex", "age", "mrn"]).to_dict("records"):
+            patients[p["id"]] = p
+    for p_id in results["PatientID"].unique():
+        patients.setdefault(p_id, {"id": p_id, "name": p_id, "sex": "", "age": "", "mrn": ""})
+    return patients, results, events
+
+def _chart_embed(chart, div_id):
+    return (
+        f'<div id="{div_id}"></div>'
+        f'<script>vegaEmbed("#{div_id}", {chart.to_json(validate=False, indent=None)}, {{"actions": false}});</script>'
+    )
+
+def render_patient_report(patient, results_df, events_df, master_df, chart_format, out_dir):
+    """One static report per patient: latest Consult rows plus a trend chart per matched marker."""
+    sel_date = results_df["Date"].dropna().max()
+    rows, counts = build_dashboard_rows(results_df, master_df, sel_date, use_latest_view=False)
+
+    table = []
+    for r in sorted(rows, key=lambda x: (x["Prio"], x["Marker"])):
+        delta_txt = f"{r['Delta']:+g}" if r["Delta"] is not None else ""
+        table.append(
+            f"<tr><td>{html.escape(str(r['Marker']))}</td><td>{r['Value']:g} {html.escape(str(r['Unit']))}</td>"
+            f"<td class='{r['StatusKey']}'>{r['StatusLabel']}</td><td>{html.escape(r['Ref'])}</td><td>{delta_txt}</td></tr>"
+        )
+
+    charts = []
+    safe_id = re.sub(r"[^A-Za-z0-9_-]", "_", str(patient["id"]))
+    for i, marker in enumerate(sorted({r["MarkerClean"] for r in rows})):
+        ch = plot_chart(marker, results_df, events_df, master_df)
+        if ch is None:
+            continue
+        if chart_format == "html":
+            charts.append(_chart_embed(ch, f"chart{i}"))
+        else:
+            fname = f"{safe_id}_{re.sub(r'[^A-Za-z0-9_-]', '_', marker)}.{chart_format}"
+            ch.save(os.path.join(out_dir, fname))
+            charts.append(f'<img src="{fname}" alt="{html.escape(marker)}">')
+
+    scripts = ""
+    if chart_format == "html":
+        scripts = (
+            f'<script src="https://cdn.jsdelivr.net/npm/vega@{alt.VEGA_VERSION}"></script>'
+            f'<script src="https://cdn.jsdelivr.net/npm/vega-lite@{alt.VEGALITE_VERSION}"></script>'
+            f'<script src="https://cdn.jsdelivr.net/npm/vega-embed@{alt.VEGAEMBED_VERSION}"></script>'
+        )
+
+    doc = f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{html.escape(str(patient.get('name', '')))} - consult summary</title>{scripts}
+<style>
+body{{font-family:Inter,Arial,sans-serif;color:#0F172A;margin:24px;}}
+table{{border-collapse:collapse;margin:12px 0 24px 0;}} td,th{{padding:6px 12px;border-bottom:1px solid #E2E8F0;text-align:left;font-size:13px;}}
+.bad{{color:#DC2626;font-weight:700;}} .warn{{color:#F59E0B;font-weight:700;}} .ok{{color:#16A34A;}} .optimal{{color:#2563EB;}}
+</style></head><body>
+<h2>{html.escape(str(patient.get('name', '')))}</h2>
+<div>{html.escape(str(patient.get('sex', '')))} {html.escape(str(patient.get('age', '')))} | Report date: {sel_date.strftime('%d %b %Y')}</div>
+<p>Out of range: {counts.get('bad', 0)} | Borderline: {counts.get('warn', 0)} | In range: {counts.get('ok', 0)} | Optimal: {counts.get('optimal', 0)}</p>
+<table><tr><th>Marker</th><th>Value</th><th>Status</th><th>Reference</th><th>Delta vs prev</th></tr>{''.join(table)}</table>
+{''.join(charts)}
+</body></html>"""
+
+    path = os.path.join(out_dir, f"{safe_id}.html")
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write(doc)
+    return path
+
+def _batch_report_worker(patient_id):
+    try:
+        results_df, events_df = get_patient_data(patient_id, _BATCH["results"], _BATCH["events"])
+        if results_df.empty or results_df["Date"].dropna().empty:
+            return patient_id, None, "no dated labs"
+        path = render_patient_report(
+            _BATCH["patients"][patient_id], results_df, events_df, _BATCH["master"], _BATCH["format"], _BATCH["out"]
+        )
+        return patient_id, path, None
+    except Exception as e:
+        return patient_id, None, str(e)
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog="clinical.py", description="Write static consult reports for every patient.")
+    parser.add_argument("--results", required=True, help="CSV with PatientID, Date, Marker, Value, Unit")
+    parser.add_argument("--patients", help="CSV with id, name, sex, age, mrn")
+    parser.add_argument("--events", help="CSV with PatientID, Date, Event, Type, Notes")
+    parser.add_argument("--out", default="reports", help="Output directory")
+    parser.add_argument("--format", choices=["html", "svg", "png"], default="html", help="Chart format (svg/png need vl-convert-python)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+    if args.format != "html":
+        try:
+            import vl_convert  # noqa: F401 - altair's static exporter
+        except ImportError:
+            parser.error(f"--format {args.format} needs vl-convert-python (pip install vl-convert-python)")
+
+    os.makedirs(args.out, exist_ok=True)
+    patients, results_df, events_df = load_patient_store(args.results, args.patients, args.events)
+    _BATCH.update(
+        patients=patients, results=results_df, events=events_df,
+        master=get_master_data(), format=args.format, out=args.out,
+    )
+    patient_ids = sorted(results_df["PatientID"].unique())
+
+    # Workers inherit the loaded store through fork; without fork the UI module cannot be re-imported safely.
+    started = time.perf_counter()
+    if args.workers > 1 and "fork" in mp.get_all_start_methods():
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=mp.get_context("fork")) as pool:
+            outcomes = list(pool.map(_batch_report_worker, patient_ids, chunksize=max(1, len(patient_ids) // (args.workers * 4))))
+    else:
+        outcomes = [_batch_report_worker(p_id) for p_id in patient_ids]
+    elapsed = time.perf_counter() - started
+
+    written = [o for o in outcomes if o[1] is not None]
+    for p_id, _, err in outcomes:
+        if err is not None:
+            print(f"skipped {p_id}: {err}", file=sys.stderr)
+    rate = len(written) / elapsed if elapsed > 0 else float("inf")
+    print(f"Wrote {len(written)}/{len(patient_ids)} reports to {args.out} in {elapsed:.1f}s ({rate:.1f} patients/s)")
+    return 0 if len(written) == len(patient_ids) else 1
+
+def _running_under_streamlit():
+    try:
+        from streamlit import runtime
+        return runtime.exists()
+    except Exception:
+        return False
+
+if __name__ == "__main__" and not _running_under_streamlit():
+    sys.exit(batch_main(sys.argv[1:]))
+
 # =========================================================
 # 9) APP STATE + TOPBAR
 # =========================================================
@@ -941,7 +1433,7 @@ pid = st.session_state["active_patient"]
 results, events = get_patient_data(pid)
 ui = st.session_state["ui"]
 
-last_date = last_lab_date(results)
+last_date = last_lab_date(pid)
 last_date_str = last_date.strftime("%d %b %Y") if last_date is not None else "-"
 patient_count = len(st.session_state["patients"])
 
@@ -1000,7 +1492,7 @@ with st.sidebar:
     st.markdown('<div class="sb-divider"></div>', unsafe_allow_html=True)
 
     st.markdown('<div class="sb-section">Navigate</div>', unsafe_allow_html=True)
-    nav_options = ["Consult", "Trends", "Interventions", "Patients"]
+    nav_options = ["Consult", "Worklist", "Cohort", "Trends", "Interventions", "Patients"]
     nav = st.radio(
         "NAV",
         nav_options,
@@ -1208,43 +1700,6 @@ if ui["open_event"]:
 # =========================================================
 # 12) PAGE HELPERS
 # =========================================================
-def build_dashboard_rows(results_df, master_df, sel_date):
-    subset = results_df[results_df["Date"] == sel_date].copy()
-    rows = []
-    counts = {"bad": 0, "warn": 0, "ok": 0, "optimal": 0}
-
-    for _, r in subset.iterrows():
-        m_row = fuzzy_match(r["Marker"], master_df)
-        if m_row is None or pd.isna(r["NumericValue"]):
-            continue
-
-        status_label, status_key, prio = get_status(r["NumericValue"], m_row)
-        counts[status_key] = counts.get(status_key, 0) + 1
-
-        s_min, s_max = parse_range(m_row["Standard Range"])
-        unit = m_row["Unit"] if pd.notna(m_row["Unit"]) else (r.get("Unit", "") or "")
-        delta = calc_delta(r["CleanMarker"], results_df, sel_date)
-
-        ref_str = ""
-        if s_min is not None and s_max is not None:
-            ref_str = f"{s_min:g}-{s_max:g} {unit}".strip()
-
-        rows.append(
-            {
-                "Marker": m_row["Biomarker"],
-                "MarkerClean": r["CleanMarker"],
-                "Value": r["NumericValue"],
-                "Unit": unit,
-                "StatusLabel": status_label,
-                "StatusKey": status_key,
-                "Prio": prio,
-                "Ref": ref_str,
-                "Delta": delta,
-            }
-        )
-
-    return rows, counts
-
 def render_rows(title, rows):
     if not rows:
         st.markdown('<div class="card"><div class="small-muted">Nothing to show.</div></div>', unsafe_allow_html=True)
@@ -1260,6 +1715,8 @@ def render_rows(title, rows):
             delta_txt = f"{arrow} {abs(r['Delta']):g} vs prev"
 
         ref_html = f"<span>Ref: {r['Ref']}</span>" if r["Ref"] else ""
+        if r.get("ClinicPct") is not None:
+            ref_html += f"<span>Clinic pct: {r['ClinicPct']:.0f}</span>"
 
         st.markdown(
             f"""
@@ -1303,6 +1760,11 @@ if nav == "Consult":
     st.markdown("</div>", unsafe_allow_html=True)
 
     rows, counts = build_dashboard_rows(results, master, sel_date)
+    pct = clinic_percentiles()
+    for r in rows:
+        entry = get_latest(pid, r["MarkerClean"])
+        if entry is not None and entry["latest_date"] == sel_date:
+            r["ClinicPct"] = pct.get((pid, r["MarkerClean"]))
     total = counts["bad"] + counts["warn"] + counts["ok"] + counts["optimal"]
 
     st.markdown(
@@ -1324,6 +1786,96 @@ if nav == "Consult":
     with right:
         render_rows("Stable / optimal", [r for r in rows if r["StatusKey"] in ["optimal", "ok"]])
 
+elif nav == "Worklist":
+    st.markdown("### Triage worklist")
+    st.markdown(
+        '<div class="small-muted">All patients ranked by out-of-range, then borderline markers on their latest values.</div>',
+        unsafe_allow_html=True,
+    )
+
+    wl = build_worklist()
+    wl = wl[wl["PatientID"].isin(st.session_state["patients"].keys())]
+    if wl.empty:
+        st.markdown('<div class="card"><div class="small-muted">No labs uploaded yet.</div></div>', unsafe_allow_html=True)
+        st.stop()
+
+    # One virtualised table instead of a markdown block and button per patient: thousands of rows stay fast
+    patients = st.session_state["patients"]
+    table = pd.DataFrame(
+        {
+            "Patient": wl["PatientID"].map(lambda p: patients[p].get("name", "")),
+            "Out of range": wl["bad"],
+            "Borderline": wl["warn"],
+            "Flagged": wl["Flagged"],
+            "Last lab": wl["LastDate"],
+        }
+    )
+    st.markdown('<div class="small-muted">Select a row to open the patient.</div>', unsafe_allow_html=True)
+    picked = st.dataframe(
+        table,
+        hide_index=True,
+        use_container_width=True,
+        on_select="rerun",
+        selection_mode="single-row",
+        key=f"worklist_{ui.get('worklist_gen', 0)}",
+        column_config={"Last lab": st.column_config.DateColumn(format="DD MMM YYYY")},
+    )
+    if picked.selection.rows:
+        set_active_patient(wl.iloc[picked.selection.rows[0]]["PatientID"])
+        ui["worklist_gen"] = ui.get("worklist_gen", 0) + 1  # fresh table (no selection) when coming back
+        ui["nav"] = "Consult"
+        st.rerun()
+
+elif nav == "Cohort":
+    st.markdown("### Cohort")
+    st.markdown(
+        '<div class="small-muted">Distribution of each patient\'s latest value across the clinic.</div>',
+        unsafe_allow_html=True,
+    )
+
+    hist = cohort_histograms()
+    if hist.empty:
+        st.markdown('<div class="card"><div class="small-muted">No labs uploaded yet.</div></div>', unsafe_allow_html=True)
+        st.stop()
+
+    topA, topB = st.columns([3, 1.2], gap="large")
+    with topA:
+        biomarker = st.selectbox("Biomarker", sorted(hist["Biomarker"].unique()))
+    with topB:
+        strat_label = st.segmented_control("Stratify", options=["None", "Sex", "Age band"], default="None")
+    stratify = {"Sex": "Sex", "Age band": "AgeBand"}.get(strat_label)
+
+    m_hist = hist[hist["Biomarker"] == biomarker]
+    layers = [
+        alt.Chart(m_hist).mark_bar(color="#2563EB", opacity=0.75).encode(
+            x=alt.X("BinStart:Q", title=biomarker, bin="binned"),
+            x2="BinEnd:Q",
+            y=alt.Y("Patients:Q", title="Patients"),
+            tooltip=[alt.Tooltip("BinStart:Q", format=".3g"), alt.Tooltip("BinEnd:Q", format=".3g"), "Patients:Q"],
+        )
+    ]
+    cf = cohort_frame()
+    own = cf[(cf["PatientID"] == pid) & (cf["Biomarker"] == biomarker)]
+    if not own.empty:
+        layers.append(
+            alt.Chart(own[["Value", "ClinicPct"]])
+            .mark_rule(color="#DC2626", strokeWidth=2)
+            .encode(
+                x="Value:Q",
+                tooltip=[alt.Tooltip("Value:Q", title=patient.get("name", "")), alt.Tooltip("ClinicPct:Q", format=".0f")],
+            )
+        )
+
+    st.markdown('<div class="card">', unsafe_allow_html=True)
+    st.altair_chart(
+        alt.layer(*layers).properties(height=320, background="#FFFFFF").configure_view(strokeWidth=0),
+        use_container_width=True,
+    )
+    st.markdown("</div>", unsafe_allow_html=True)
+
+    stats = cohort_stats(stratify)
+    st.dataframe(stats[stats["Biomarker"] == biomarker].drop(columns=["Biomarker"]), hide_index=True, use_container_width=True)
+
 elif nav == "Trends":
     if results.empty:
         st.warning(f"No data for {patient.get('name','')}. Use Upload lab in the sidebar.")
@@ -7,36 +7,177 @@ import io
 import time
 import re
 import os
+import threading
+import sqlite3
+import hashlib
+import pickle
+import weakref
+import heapq
+import itertools
 import altair as alt
 import google.generativeai as genai
+from abc import ABC, abstractmethod
 from difflib import SequenceMatcher
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from google.generativeai.types import HarmCategory, HarmBlockThreshold, GenerationConfig
+from lab_units import canonicalize, CSV_LAYOUTS
+try: from pypdf import PdfReader, PdfWriter
+except ImportError: PdfReader = PdfWriter = None  # PDFs are then sent to the model whole
+try: from PIL import Image, ImageOps
+except ImportError: Image = ImageOps = None  # photos are then sent as uploaded
 
 # --- 1. CONFIGURATION ---
 st.set_page_config(page_title="HealthOS", layout="wide", initial_sidebar_state="collapsed")
 
+# --- SHEETS QUOTA ---
+# Every gspread HTTP request in the process takes a token from a shared per-minute bucket (reads and
+# writes are separate Sheets quotas). When a bucket is empty callers queue instead of failing, the
+# interactive script thread goes ahead of background work, and a 429 that slips through empties the
+# bucket and is retried after a backoff.
+SHEETS_QUOTA_PER_MINUTE = {"read": 60, "write": 60}  # default per-user Sheets API quotas
+SHEETS_429_RETRIES = 5
+INTERACTIVE, BACKGROUND = 0, 1
+_io_priority = threading.local()
+
+def set_io_priority(level): _io_priority.level = level
+
+class SheetsQuota:
+    def __init__(self, per_minute):
+        self.cond = threading.Condition()
+        self.capacity = {k: float(v) for k, v in per_minute.items()}
+        self.tokens = dict(self.capacity)
+        self.refilled = {k: time.monotonic() for k in per_minute}
+        self.waiters = {k: [] for k in per_minute}  # heap of (priority, ticket)
+        self.recent = {k: deque() for k in per_minute}  # request times over the last minute
+        self.tickets = itertools.count()
+
+    def _refill(self, kind, now):
+        self.tokens[kind] = min(self.capacity[kind], self.tokens[kind] + (now - self.refilled[kind]) * self.capacity[kind] / 60.0)
+        self.refilled[kind] = now
+
+    def acquire(self, kind):
+        with self.cond:
+            me = (getattr(_io_priority, 'level', INTERACTIVE), next(self.tickets))
+            heapq.heappush(self.waiters[kind], me)
+            while True:
+                now = time.monotonic()
+                self._refill(kind, now)
+                if self.waiters[kind][0] == me and self.tokens[kind] >= 1:
+                    heapq.heappop(self.waiters[kind])
+                    self.tokens[kind] -= 1
+                    self.recent[kind].append(now)
+                    self.cond.notify_all()
+                    return
+                head_wait = (1 - self.tokens[kind]) * 60.0 / self.capacity[kind]
+                self.cond.wait(timeout=max(head_wait, 0.05) if self.waiters[kind][0] == me else 1.0)
+
+    def drain(self, kind):
+        """The API says we are over quota (e.g. other processes share it): start refilling from zero."""
+        with self.cond: self.tokens[kind] = 0.0
+
+    def usage(self):
+        with self.cond:
+            now, out = time.monotonic(), {}
+            for kind, recent in self.recent.items():
+                while recent and now - recent[0] > 60: recent.popleft()
+                out[kind] = {"used": len(recent), "limit": int(self.capacity[kind]), "queued": len(self.waiters[kind])}
+            return out
+
+@st.cache_resource
+def sheets_quota():
+    per_minute = dict(SHEETS_QUOTA_PER_MINUTE)
+    try:
+        for kind in per_minute: per_minute[kind] = int(st.secrets.get(f"SHEETS_{kind.upper()}S_PER_MINUTE", per_minute[kind]))
+    except: pass  # no secrets file
+    return SheetsQuota(per_minute)
+
+def throttle_client(client):
+    """Route the client's HTTP requests through sheets_quota(); older gspread releases request on the client itself."""
+    http = getattr(client, 'http_client', client)
+    send = http.request
+    def request(method, *args, **kwargs):
+        kind = "read" if str(method).lower() == "get" else "write"
+        quota = sheets_quota()
+        for attempt in range(SHEETS_429_RETRIES + 1):
+            quota.acquire(kind)
+            try: return send(method, *args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                if getattr(e, 'code', None) != 429 or attempt == SHEETS_429_RETRIES: raise
+                quota.drain(kind)
+                time.sleep(min(2 ** attempt, 32))
+    http.request = request
+    return client
+
+def quota_status_line():
+    u = sheets_quota().usage()
+    line = " · ".join(f"{k}s {v['used']}/{v['limit']}" for k, v in u.items())
+    queued = sum(v['queued'] for v in u.values())
+    return f"Sheets API, last minute: {line}" + (f" · {queued} queued" if queued else "")
+
 # --- AUTHENTICATION ---
-def get_google_sheet_client():
+# One authorized client, spreadsheet and set of worksheet handles per process. Failures raise inside the
+# cached builders so they are not cached; the public getters keep returning None on auth failure.
+@st.cache_resource
+def _authorized_client():
     scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
     current_dir = os.path.dirname(os.path.abspath(__file__))
     key_file_path = os.path.join(current_dir, "service_account.json")
     if os.path.exists(key_file_path):
-        try:
-            creds = ServiceAccountCredentials.from_json_keyfile_name(key_file_path, scope)
-            return gspread.authorize(creds)
-        except: return None
+        creds = ServiceAccountCredentials.from_json_keyfile_name(key_file_path, scope)
     elif "gcp_service_account" in st.secrets:
-        try:
-            secret_value = st.secrets["gcp_service_account"]
-            if isinstance(secret_value, str):
-                creds_dict = json.loads(secret_value)
-            else:
-                creds_dict = secret_value
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-            return gspread.authorize(creds)
-        except: return None
-    else: return None
+        secret_value = st.secrets["gcp_service_account"]
+        if isinstance(secret_value, str):
+            creds_dict = json.loads(secret_value)
+        else:
+            creds_dict = secret_value
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+    else: raise RuntimeError("No service account configured")
+    # gspread wraps these in an authorized session that refreshes the access token on expiry
+    return throttle_client(gspread.authorize(creds))
+
+def get_google_sheet_client():
+    try:
+        client = _authorized_client()
+    except: return None
+    # Older gspread releases do not refresh oauth2client tokens on their own
+    if hasattr(client, 'login') and getattr(getattr(client, 'auth', None), 'access_token_expired', False): client.login()
+    return client
+
+@st.cache_resource
+def get_spreadsheet():
+    client = get_google_sheet_client()
+    if not client: raise RuntimeError("Auth Failed")
+    return client.open(SHEET_NAME)
+
+@st.cache_resource
+def _worksheet_handles():
+    return {"lock": threading.Lock(), "worksheets": {}}
+
+def get_worksheet(title, create=None):
+    """Cached worksheet handle. create=(rows, cols, header_row or None) adds the sheet when it is missing."""
+    h = _worksheet_handles()
+    with h['lock']:
+        ws = h['worksheets'].get(title)
+        if ws is None:
+            sh = get_spreadsheet()
+            try: ws = sh.worksheet(title)
+            except gspread.exceptions.WorksheetNotFound:
+                if create is None: raise
+                rows, cols, header = create
+                ws = sh.add_worksheet(title=title, rows=rows, cols=cols)
+                if header: ws.append_row(header)
+                if title.startswith("Results"): invalidate_results_mirror(title)
+            h['worksheets'][title] = ws
+        return ws
+
+def reset_sheet_handles():
+    """Drop cached spreadsheet/worksheet handles, e.g. after an API error or a sheet deleted elsewhere."""
+    h = _worksheet_handles()
+    with h['lock']: h['worksheets'].clear()
+    get_spreadsheet.clear()
 
 # --- API SETUP ---
 import google.generativeai as genai
@@ -152,109 +293,813 @@ st.markdown("""
 SHEET_NAME = "HealthOS_DB"
 MASTER_FILE_LOCAL = "Biomarker_Master_Elite.csv"
 REQUIRED_COLUMNS = ['Marker', 'Value', 'Unit', 'Flag', 'Date', 'Source']
+RESULTS_FULL_RESYNC_SECONDS = 300
+RESULTS_INDEX_SHEET = "Results Index"
+INDEX_COLUMNS = ['Date', 'Shard', 'Rows']
+MASTER_CACHE_SECONDS = 3600
+MASTER_CHECK_SECONDS = 30  # how stale a Master sheet edit can be before the long-lived copy is replaced
+
+@st.cache_resource
+def results_mirror(title="Results"):
+    """Process-wide copy of one Results worksheet: raw rows as last seen, plus the cleaned frame built from them."""
+    return {"lock": threading.Lock(), "headers": None, "columns": None, "offset": 1, "rows": [], "frame": None, "full_at": 0.0, "master_sum": None}
+
+def invalidate_results_mirror(title="Results"):
+    m = results_mirror(title)
+    with m['lock']: m['headers'] = None
+
+def results_shard(date_str):
+    """Worksheet holding the Results rows of one date: one per year."""
+    d = pd.to_datetime(date_str, errors='coerce')
+    return f"Results {d.year}" if pd.notna(d) else "Results undated"
+
+def results_index_from(results):
+    counts = results['Date'].astype(str).value_counts(sort=False)
+    return pd.DataFrame({"Date": counts.index, "Shard": counts.index.map(results_shard), "Rows": counts.values}, columns=INDEX_COLUMNS)
+
+def _trim_row(row): 
+    row = list(row)
+    while row and row[-1] == "": row.pop()
+    return row
+
+def prepare_results(results, master):
+    for col in REQUIRED_COLUMNS:
+        if col not in results.columns: results[col] = ""
+    if not results.empty:
+        results['Date'] = pd.to_datetime(results['Date'], errors='coerce')
+        results = results.dropna(subset=['Date'])
+        results = results.dropna(subset=['Value'])
+        results = results[results['Value'].astype(str).str.strip() != ""]
+        results = apply_unit_conversions(results, master)
+    return results
+
+def sync_results(ws_res, get_master):
+    """
+    Append-only fast path: re-read the last known row as an anchor plus everything after it.
+    If the anchor no longer matches (rewrite, delete, reorder) fall back to a full reload; edits above
+    the anchor are picked up by the periodic full reload every RESULTS_FULL_RESYNC_SECONDS.
+    get_master is only called once the sheet read is done, so the Master fetch can run alongside it;
+    a Master with a different checksum re-derives the cached frame from the raw rows.
+    """
+    m = results_mirror(ws_res.title)
+    with m['lock']:
+        n = len(m['rows'])
+        full = m['headers'] is None or n == 0 or time.time() - m['full_at'] > RESULTS_FULL_RESYNC_SECONDS
+        if not full:
+            first_row = n + m['offset']  # sheet row of the last known data row
+            last_col = gspread.utils.rowcol_to_a1(1, max(len(m['headers']), len(REQUIRED_COLUMNS))).rstrip("0123456789")
+            tail = ws_res.get(f"A{first_row}:{last_col}")
+            if tail and _trim_row(tail[0]) == _trim_row(m['rows'][-1]):
+                new_rows = [r + [""] * (len(m['columns']) - len(r)) for r in tail[1:]]
+                master = get_master()
+                if master.attrs.get('checksum') != m['master_sum']:
+                    m['rows'].extend(new_rows)
+                    m['frame'] = prepare_results(pd.DataFrame([r[:len(m['columns'])] for r in m['rows']], columns=m['columns']), master)
+                    m['master_sum'] = master.attrs.get('checksum')
+                elif new_rows:
+                    m['rows'].extend(new_rows)
+                    added = prepare_results(pd.DataFrame([r[:len(m['columns'])] for r in new_rows], columns=m['columns']), master)
+                    m['frame'] = pd.concat([m['frame'], added], ignore_index=True)
+                return m['frame'].copy()
+            full = True
+
+        data = ws_res.get_all_values()
+        if not data:
+            m['headers'], m['columns'], m['offset'], m['rows'] = [], REQUIRED_COLUMNS, 1, []
+            results = pd.DataFrame(columns=REQUIRED_COLUMNS)
+        else:
+            headers = data[0]
+            m['headers'] = headers
+            if "Marker" in headers:
+                m['columns'], m['offset'], m['rows'] = headers, 1, data[1:]
+            else:
+                m['columns'], m['offset'], m['rows'] = REQUIRED_COLUMNS[:len(data[0])], 0, data
+            results = pd.DataFrame(m['rows'], columns=m['columns'])
+        master = get_master()
+        m['frame'] = prepare_results(results, master)
+        m['master_sum'] = master.attrs.get('checksum')
+        m['full_at'] = time.time()
+        return m['frame'].copy()
+
+def _cell_rows(rows):
+    return [{"values": [{"userEnteredValue": {"stringValue": v}} for v in r]} for r in rows]
+
+def _contiguous_runs(row_numbers):
+    """Sorted sheet row numbers -> [(first, last)] runs of consecutive rows."""
+    runs = []
+    for r in row_numbers:
+        if runs and r == runs[-1][1] + 1: runs[-1][1] = r
+        else: runs.append([r, r])
+    return [tuple(x) for x in runs]
+
+def diff_results_requests(sheet_id, date_column, new_rows, target_dates, first_data_row=2):
+    """
+    batchUpdate requests that replace the rows of target_dates with new_rows: overwrite the first
+    replaced rows in place, delete the surplus bottom-up, append whatever is left. Returns (requests, replaced).
+    """
+    replaced = [i + first_data_row for i, d in enumerate(date_column) if d in target_dates]
+    overwrite, surplus = replaced[:len(new_rows)], replaced[len(new_rows):]
+    requests, cursor = [], 0
+    for first, last in _contiguous_runs(overwrite):
+        chunk = new_rows[cursor:cursor + last - first + 1]
+        cursor += len(chunk)
+        requests.append({"updateCells": {"start": {"sheetId": sheet_id, "rowIndex": first - 1, "columnIndex": 0},
+                                         "rows": _cell_rows(chunk), "fields": "userEnteredValue"}})
+    for first, last in reversed(_contiguous_runs(surplus)):
+        requests.append({"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": first - 1, "endIndex": last}}})
+    if cursor < len(new_rows):
+        requests.append({"appendCells": {"sheetId": sheet_id, "rows": _cell_rows(new_rows[cursor:]), "fields": "userEnteredValue"}})
+    return requests, replaced
+
+# --- STORAGE BACKENDS ---
+# Everything that persists Master, Results or Profile goes through one of these. Results are exchanged
+# as raw string frames with REQUIRED_COLUMNS; save_results replaces every stored row sharing a Date
+# with the incoming rows. Pick the backend with STORAGE_BACKEND ("sheets" | "mirror" | "sqlite") in secrets
+# or the HEALTHOS_STORAGE environment variable.
+class StorageBackend(ABC):
+    name = "base"
+    write_behind = False  # saves go through the background write queue
+
+    @abstractmethod
+    def read_master(self): ...  # raw DataFrame, or None when there is none
+    @abstractmethod
+    def write_master(self, master): ...
+    @abstractmethod
+    def read_results_raw(self, dates=None): ...  # dates: stored Date strings to read, None = all
+    def read_results(self, get_master, dates=None): return prepare_results(self.read_results_raw(dates), get_master())
+    def read_results_index(self, get_master): return results_index_from(self.read_results_raw())  # one row per stored Date
+    @abstractmethod
+    def save_results(self, new_df): ...
+    @abstractmethod
+    def clear_results(self): ...
+    @abstractmethod
+    def read_profile(self): ...
+    @abstractmethod
+    def save_profile(self, profile): ...
+    def reset(self): pass  # drop cached connections/handles after an error
+
+class SheetsBackend(StorageBackend):
+    """
+    Results live in one worksheet per year ("Results 2024", ...) listed in a small "Results Index" sheet
+    with one row per lab date, so a page reads only the years it shows. A spreadsheet that still has the
+    single legacy "Results" sheet keeps using it until split_results_by_year() is run.
+    """
+    name = "sheets"
+    write_behind = True
+
+    def __init__(self): self._legacy = None
+
+    def read_master(self):
+        if not get_google_sheet_client(): raise RuntimeError("Auth Failed")
+        try: m_data = get_worksheet("Master").get_all_values()
+        except: return None
+        return pd.DataFrame(m_data[1:], columns=m_data[0]) if len(m_data) > 1 else None
+
+    def write_master(self, master):
+        ws = get_worksheet("Master", create=(max(len(master) + 1, 100), max(len(master.columns), 7), None))
+        ws.clear()
+        ws.update(values=[list(master.columns)] + master.fillna("").astype(str).values.tolist())
+
+    def _index_ws(self):
+        """The index worksheet, or None for a legacy single-sheet spreadsheet. A new spreadsheet starts sharded."""
+        if self._legacy is None:
+            try: get_worksheet(RESULTS_INDEX_SHEET); self._legacy = False
+            except gspread.exceptions.WorksheetNotFound:
+                try: get_worksheet("Results"); self._legacy = True
+                except gspread.exceptions.WorksheetNotFound: self._legacy = False
+        return None if self._legacy else get_worksheet(RESULTS_INDEX_SHEET, create=(100, len(INDEX_COLUMNS), INDEX_COLUMNS))
+
+    def _index_rows(self, ws_index):
+        return {r[0]: (r[1], int(r[2] or 0)) for r in ws_index.get_all_values()[1:] if len(r) >= 3 and r[0]}
+
+    def _write_index(self, ws_index, index):
+        # Overwrite in place, then blank what is left below: the index is never seen empty mid-write
+        values = [INDEX_COLUMNS] + [[d, s, n] for d, (s, n) in sorted(index.items())]
+        ws_index.update(values=values, range_name="A1")
+        ws_index.batch_clear([f"A{len(values) + 1}:C"])
+
+    def _raw_sheet(self, ws):
+        data = ws.get_all_values()
+        if not data: return pd.DataFrame(columns=REQUIRED_COLUMNS)
+        if "Marker" in data[0]: return pd.DataFrame(data[1:], columns=data[0]).reindex(columns=REQUIRED_COLUMNS).fillna("")
+        return pd.DataFrame(data, columns=REQUIRED_COLUMNS[:len(data[0])]).reindex(columns=REQUIRED_COLUMNS).fillna("")
+
+    def _shards(self, dates):
+        ws_index = self._index_ws()
+        if ws_index is None: return [get_worksheet("Results", create=(1000, 10, REQUIRED_COLUMNS))]
+        titles = {s for s, _ in self._index_rows(ws_index).values()} if dates is None else {results_shard(d) for d in dates}
+        shards = []
+        for title in sorted(titles):
+            try: shards.append(get_worksheet(title))
+            except gspread.exceptions.WorksheetNotFound: pass
+        return shards
+
+    def read_results_raw(self, dates=None):
+        frames = [self._raw_sheet(ws) for ws in self._shards(dates)]
+        raw = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=REQUIRED_COLUMNS)
+        return raw if dates is None else raw[raw['Date'].isin(dates)]
+
+    def read_results(self, get_master, dates=None):
+        frames = [sync_results(ws, get_master) for ws in self._shards(dates)]
+        results = pd.concat(frames, ignore_index=True) if frames else prepare_results(pd.DataFrame(columns=REQUIRED_COLUMNS), get_master())
+        return results if dates is None else results[results['Date'].isin(pd.to_datetime(list(dates), errors='coerce'))]
+
+    def read_results_index(self, get_master):
+        ws_index = self._index_ws()
+        if ws_index is None: return results_index_from(self._legacy_raw(get_master))
+        return pd.DataFrame([[d, s, n] for d, (s, n) in self._index_rows(ws_index).items()], columns=INDEX_COLUMNS)
+
+    def _legacy_raw(self, get_master):
+        """Raw rows of the single "Results" sheet, counted like the index sheet does, served by the synced mirror."""
+        ws = get_worksheet("Results", create=(1000, 10, REQUIRED_COLUMNS))
+        sync_results(ws, get_master)
+        m = results_mirror(ws.title)
+        with m['lock']: raw = pd.DataFrame([r[:len(m['columns'])] for r in m['rows']], columns=m['columns'])
+        return raw.reindex(columns=REQUIRED_COLUMNS).fillna("")
+
+    def _save_rows(self, ws, new_df):
+        target_dates = new_df['Date'].unique()
+        headers = ws.row_values(1)
+        if not headers:
+            ws.append_row(REQUIRED_COLUMNS)
+            headers = REQUIRED_COLUMNS
+        if 'Date' not in headers:
+            # Header-less legacy sheet: normalise it with one full rewrite
+            existing_data = ws.get_all_values()
+            existing_df = pd.DataFrame(existing_data, columns=REQUIRED_COLUMNS[:len(existing_data[0])]) if existing_data else pd.DataFrame(columns=REQUIRED_COLUMNS)
+            final_df = pd.concat([existing_df[~existing_df['Date'].isin(target_dates)], new_df], ignore_index=True).fillna("").astype(str)
+            ws.clear()
+            ws.append_row(REQUIRED_COLUMNS)
+            ws.append_rows(final_df[REQUIRED_COLUMNS].values.tolist())
+            invalidate_results_mirror(ws.title)
+        else:
+            # Only the Date column is read; replaced dates are overwritten/deleted and new rows appended in one atomic batch
+            date_column = ws.col_values(headers.index('Date') + 1)[1:]
+            aligned = new_df.reindex(columns=headers).fillna("").astype(str).values.tolist()
+            requests, replaced = diff_results_requests(ws.id, date_column, aligned, set(target_dates))
+            if requests: ws.spreadsheet.batch_update({"requests": requests})
+            if replaced: invalidate_results_mirror(ws.title)  # in-place edits are invisible to the append-only sync
+
+    def save_results(self, new_df):
+        ws_index = self._index_ws()
+        if ws_index is None: return self._save_rows(get_worksheet("Results", create=(1000, 10, None)), new_df)
+        for shard, part in new_df.groupby(new_df['Date'].map(results_shard)):
+            self._save_rows(get_worksheet(shard, create=(1000, 10, REQUIRED_COLUMNS)), part)
+        index = self._index_rows(ws_index)
+        for d, n in new_df['Date'].value_counts().items(): index[d] = (results_shard(d), int(n))
+        self._write_index(ws_index, index)
+
+    def clear_results(self):
+        ws_index = self._index_ws()
+        shards = self._shards(None) if ws_index is not None else [get_worksheet("Results", create=(1000, 10, None))]
+        for ws in shards:
+            ws.clear()
+            ws.append_row(REQUIRED_COLUMNS)
+            invalidate_results_mirror(ws.title)
+        if ws_index is not None: self._write_index(ws_index, {})
+
+    def results_sharded(self): return self._index_ws() is not None
+
+    def split_results_by_year(self):
+        """One-off migration of the legacy "Results" sheet into year shards; the old sheet is left as a backup."""
+        raw = self._raw_sheet(get_worksheet("Results"))
+        self._legacy = False
+        self._write_index(self._index_ws(), {})
+        if not raw.empty: self.save_results(raw)
+
+    def read_profile(self):
+        try: p_data = get_worksheet("Profile").get_all_values()
+        except: return {}
+        return {r[0]: r[1] for r in p_data if len(r) >= 2}
+
+    def save_profile(self, profile):
+        ws = get_worksheet("Profile", create=(100, 2, None))
+        ws.clear()
+        ws.update(values=[[k, str(v)] for k, v in profile.items()])
+
+    def reset(self):
+        self._legacy = None
+        reset_sheet_handles()
+
+SQLITE_FILE_LOCAL = "healthos.db"
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    Marker TEXT NOT NULL DEFAULT '', Value TEXT NOT NULL DEFAULT '', Unit TEXT NOT NULL DEFAULT '',
+    Flag TEXT NOT NULL DEFAULT '', Date TEXT NOT NULL DEFAULT '', Source TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS results_date ON results (Date);
+DROP INDEX IF EXISTS results_marker_date; -- created by earlier versions, never queried
+CREATE TABLE IF NOT EXISTS master (position INTEGER PRIMARY KEY, row TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS profile (key TEXT PRIMARY KEY, value TEXT NOT NULL DEFAULT '');
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+class SQLiteBackend(StorageBackend):
+    """
+    Single-file local store. Results keep insertion order through the rowid; the Date index makes the
+    replace-by-date on save a range delete and covers the per-date index. Master rows are stored as JSON
+    objects because its columns are whatever the CSV/sheet carries.
+    """
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()  # one connection shared by all script threads
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+
+    def read_master(self):
+        with self.lock: rows = self.conn.execute("SELECT row FROM master ORDER BY position").fetchall()
+        return pd.DataFrame([json.loads(r[0]) for r in rows]) if rows else None
+
+    def write_master(self, master):
+        rows = [(i, json.dumps(r)) for i, r in enumerate(master.fillna("").astype(str).to_dict('records'))]
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM master")
+            self.conn.executemany("INSERT INTO master (position, row) VALUES (?, ?)", rows)
+
+    def read_results_raw(self, dates=None):
+        cols = ", ".join(REQUIRED_COLUMNS)
+        if dates is None:
+            with self.lock: return pd.read_sql_query(f"SELECT {cols} FROM results ORDER BY id", self.conn)
+        dates = list(dates)
+        if not dates: return pd.DataFrame(columns=REQUIRED_COLUMNS)
+        with self.lock: return pd.read_sql_query(f"SELECT {cols} FROM results WHERE Date IN ({', '.join('?' * len(dates))}) ORDER BY id", self.conn, params=dates)
+
+    def read_results_index(self, get_master):
+        # Covered by the Date index: no table rows are touched
+        with self.lock: rows = self.conn.execute("SELECT Date, COUNT(*) FROM results GROUP BY Date").fetchall()
+        return pd.DataFrame([[d, results_shard(d), n] for d, n in rows], columns=INDEX_COLUMNS)
+
+    def save_results(self, new_df): self.replace_dates(new_df['Date'].unique(), new_df)
+
+    def replace_dates(self, dates, new_df):
+        dates = [str(d) for d in dates]
+        rows = new_df.reindex(columns=REQUIRED_COLUMNS).fillna("").astype(str).values.tolist()
+        with self.lock, self.conn:
+            self.conn.execute(f"DELETE FROM results WHERE Date IN ({', '.join('?' * len(dates))})", dates)
+            self.conn.executemany(f"INSERT INTO results ({', '.join(REQUIRED_COLUMNS)}) VALUES ({', '.join('?' * len(REQUIRED_COLUMNS))})", rows)
+
+    def clear_results(self):
+        with self.lock, self.conn: self.conn.execute("DELETE FROM results")
+
+    def read_profile(self):
+        with self.lock: return dict(self.conn.execute("SELECT key, value FROM profile").fetchall())
+
+    def save_profile(self, profile):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM profile")
+            self.conn.executemany("INSERT INTO profile (key, value) VALUES (?, ?)", [(k, str(v)) for k, v in profile.items()])
+
+    def get_meta(self, key):
+        with self.lock: row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn: self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+# --- OFFLINE-FIRST MIRROR ---
+MIRROR_FILE_LOCAL = "healthos_mirror.db"
+MIRROR_PULL_SECONDS = 30
+MIRROR_FULL_PULL_EVERY = 20  # pulls; the others only fetch dates whose row count changed
+
+class MirroredBackend(StorageBackend):
+    """
+    Offline-first: every read is served by a local SQLite copy. Writes land there first and are pushed to
+    the remote (Sheets) by a WriteBehind queue; a reconciler thread pulls remote changes every
+    MIRROR_PULL_SECONDS. Dates with unpushed local changes are never overwritten by a pull, and the app
+    keeps serving the local copy while the remote is unreachable.
+    """
+    name = "mirror"
+
+    def __init__(self, remote, local, queue_path):
+        self.remote, self.local = remote, local
+        self.error = None
+        self.wake = threading.Event()
+        self.queue = WriteBehind(remote, queue_path)
+        if local.get_meta("last_pull") is None:
+            try: self.pull(full=True)  # first start: fill the copy before serving it
+            except Exception as e: self.error = str(e)[:120]
+        threading.Thread(target=self._reconcile, name="healthos-reconciler", daemon=True).start()
+
+    def read_master(self): return self.local.read_master()
+    def write_master(self, master): self.local.write_master(master)
+    def read_results_raw(self, dates=None): return self.local.read_results_raw(dates)
+    def read_results(self, get_master, dates=None): return self.local.read_results(get_master, dates)
+    def read_results_index(self, get_master): return self.local.read_results_index(get_master)
+    def read_profile(self): return self.local.read_profile()
+
+    def save_results(self, new_df):
+        self.local.save_results(new_df)
+        self.queue.enqueue([(f"results:{d}", new_df[new_df['Date'] == d].fillna("").astype(str).values.tolist()) for d in new_df['Date'].unique()])
+
+    def clear_results(self):
+        self.local.clear_results()
+        self.queue.enqueue([("results:clear", None)])
+
+    def save_profile(self, profile):
+        self.local.save_profile(profile)
+        self.queue.enqueue([("profile", {k: str(v) for k, v in profile.items()})])
+
+    def pull(self, full=False):
+        get_master = lambda: normalize_master(self.local.read_master())  # not load_master: this also runs inside get_storage()
+        pending = {k for _, k, _ in self.queue.pending()}
+        touched = set()
+
+        master = self.remote.read_master()
+        local_master = self.local.read_master()
+        if master is not None and (local_master is None or not master.astype(str).equals(local_master.astype(str))):
+            self.local.write_master(master)
+            touched.add("master")
+
+        profile = self.remote.read_profile()
+        if "profile" not in pending and profile != self.local.read_profile():
+            self.local.save_profile(profile)
+            touched.add("profile")
+
+        if "results:clear" not in pending:
+            remote_idx, local_idx = self.remote.read_results_index(get_master), self.local.read_results_index(get_master)
+            remote_rows, local_rows = dict(zip(remote_idx['Date'], remote_idx['Rows'])), dict(zip(local_idx['Date'], local_idx['Rows']))
+            check = set(remote_rows) if full else {d for d, n in remote_rows.items() if local_rows.get(d) != n}
+            check = sorted(d for d in check if f"results:{d}" not in pending)
+            gone = [d for d in local_rows if d not in remote_rows and f"results:{d}" not in pending]
+            changed = []
+            if check:
+                remote_raw = self.remote.read_results_raw(check).astype(str).reset_index(drop=True)
+                local_raw = self.local.read_results_raw(check).astype(str)
+                for d in check:
+                    r, l = remote_raw[remote_raw['Date'] == d].reset_index(drop=True), local_raw[local_raw['Date'] == d].reset_index(drop=True)
+                    if not r.equals(l): changed.append(d)
+            if changed or gone:
+                self.local.replace_dates(changed + gone, remote_raw[remote_raw['Date'].isin(changed)] if changed else pd.DataFrame(columns=REQUIRED_COLUMNS))
+                touched.add("results")
+
+        self.local.set_meta("last_pull", datetime.now().isoformat(timespec="seconds"))
+        self.error = None
+        if touched: invalidate_datasets(*touched)
+
+    def _reconcile(self):
+        set_io_priority(BACKGROUND)
+        cycle = 0
+        while True:
+            self.wake.wait(MIRROR_PULL_SECONDS)
+            self.wake.clear()
+            cycle += 1
+            if self.queue.pending(): continue  # push local changes before pulling
+            try: self.pull(full=cycle % MIRROR_FULL_PULL_EVERY == 0)
+            except Exception as e:
+                self.error = "rate limited" if getattr(e, 'code', None) == 429 else str(e)[:120]
+                self.remote.reset()
+
+    def sync_state(self):
+        return {"pending": len(self.queue.pending()), "last_pull": self.local.get_meta("last_pull"),
+                "error": self.error or self.queue.status['error']}
+
+def storage_setting(env_key, secret_key, default):
+    if os.environ.get(env_key): return os.environ[env_key]
+    try: return st.secrets.get(secret_key, default)
+    except: return default  # no secrets file at all
+
+def local_path(env_key, secret_key, default):
+    path = storage_setting(env_key, secret_key, default)
+    return path if os.path.isabs(path) else os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+
+@st.cache_resource
+def get_storage():
+    """
+    STORAGE_BACKEND: "sheets" (default; direct), "sqlite" (local only) or "mirror" (opt-in offline-first:
+    Sheets behind a local copy at MIRROR_PATH, pushed through the queue at WRITE_QUEUE_PATH). Set it in
+    secrets.toml (STORAGE_BACKEND = "mirror") or with HEALTHOS_STORAGE=mirror.
+    """
+    kind = str(storage_setting("HEALTHOS_STORAGE", "STORAGE_BACKEND", "sheets")).lower()
+    if kind == "sqlite": return SQLiteBackend(local_path("HEALTHOS_SQLITE_PATH", "SQLITE_PATH", SQLITE_FILE_LOCAL))
+    if kind != "mirror": return SheetsBackend()
+    return MirroredBackend(SheetsBackend(), SQLiteBackend(local_path("HEALTHOS_MIRROR_PATH", "MIRROR_PATH", MIRROR_FILE_LOCAL)),
+                           local_path("HEALTHOS_QUEUE_PATH", "WRITE_QUEUE_PATH", WRITE_QUEUE_FILE))
+
+def copy_storage(source, target):
+    """Migrate everything from one backend to another, e.g. Sheets -> SQLite when switching to the local store."""
+    master = source.read_master()
+    if master is not None: target.write_master(master)
+    results = source.read_results_raw()
+    target.clear_results()
+    if not results.empty: target.save_results(results)
+    target.save_profile(source.read_profile())
+
+# --- WRITE-BEHIND QUEUE ---
+# Saves against a remote backend are queued in a local SQLite file and flushed by one background thread,
+# so the script thread never waits on the Sheets API and a burst of uploads becomes a single batch.
+WRITE_QUEUE_FILE = "healthos_queue.db"
+WRITE_BATCH_SECONDS = 2
+WRITE_MAX_BACKOFF = 60
+
+class WriteBehind:
+    """
+    Durable queue of Results/Profile mutations. Entries are coalesced by key on enqueue: one per Results
+    date ('results:<date>'), one 'profile', and 'results:clear' drops every Results entry queued before it.
+    A flush sends each kind in one backend call; on failure the batch stays queued and is retried with
+    exponential backoff.
+    """
+    def __init__(self, store, path):
+        self.store = store
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.status = {"flushed": 0, "last_flush": None, "error": None, "retry_at": None}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn: self.conn.execute("CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, payload TEXT NOT NULL)")
+        threading.Thread(target=self._run, name="healthos-write-behind", daemon=True).start()
+        self.wake.set()  # entries left over from a previous process
+
+    def enqueue(self, entries):
+        with self.lock, self.conn:
+            for key, payload in entries:
+                if key == "results:clear": self.conn.execute("DELETE FROM pending WHERE key LIKE 'results:%'")
+                else: self.conn.execute("DELETE FROM pending WHERE key = ?", (key,))
+                self.conn.execute("INSERT INTO pending (key, payload) VALUES (?, ?)", (key, json.dumps(payload)))
+        self.wake.set()
+
+    def pending(self):
+        with self.lock: rows = self.conn.execute("SELECT id, key, payload FROM pending ORDER BY id").fetchall()
+        return [(i, k, json.loads(p)) for i, k, p in rows]
+
+    # Queued mutations applied on top of loaded data, so a save is visible before it is flushed
+    def _pending_results(self):
+        batch = self.pending()
+        cleared = any(k == "results:clear" for _, k, _ in batch)
+        return cleared, [(k.split(":", 1)[1], p) for _, k, p in batch if k.startswith("results:") and k != "results:clear"]
+
+    def overlay_index(self, index):
+        cleared, saves = self._pending_results()
+        if cleared: index = index.iloc[0:0]
+        if saves:
+            queued = pd.DataFrame([[d, results_shard(d), len(rows)] for d, rows in saves], columns=INDEX_COLUMNS)
+            index = pd.concat([index[~index['Date'].isin(queued['Date'])], queued], ignore_index=True)
+        return index
+
+    def overlay_results(self, results, master, dates=None):
+        cleared, saves = self._pending_results()
+        if cleared: results = results.iloc[0:0]
+        saves = [(d, rows) for d, rows in saves if dates is None or d in dates]
+        if saves:
+            replaced = pd.to_datetime([d for d, _ in saves], errors='coerce')
+            added = prepare_results(pd.DataFrame([r for _, rows in saves for r in rows], columns=REQUIRED_COLUMNS), master)
+            results = pd.concat([results[~results['Date'].isin(replaced)], added], ignore_index=True)
+        return results
+
+    def overlay_profile(self, profile):
+        for _, k, p in self.pending():
+            if k == "profile": profile = p
+        return profile
+
+    def flush(self):
+        batch = self.pending()
+        if not batch: return
+        keys = {k for _, k, _ in batch}
+        rows = [r for _, k, p in batch if k.startswith("results:") and k != "results:clear" for r in p]
+        if "results:clear" in keys: self.store.clear_results()
+        if rows: self.store.save_results(pd.DataFrame(rows, columns=REQUIRED_COLUMNS))
+        for _, k, p in batch:
+            if k == "profile": self.store.save_profile(p)
+        # Invalidate before dequeuing: a load in between re-reads the new data and overlays it idempotently
+        invalidate_datasets(*{k.split(":")[0] for k in keys})
+        ids = [i for i, _, _ in batch]
+        with self.lock, self.conn: self.conn.execute(f"DELETE FROM pending WHERE id IN ({', '.join('?' * len(ids))})", ids)
+        self.status.update(flushed=self.status['flushed'] + len(batch), last_flush=datetime.now(), error=None, retry_at=None)
+
+    def _run(self):
+        set_io_priority(BACKGROUND)
+        delay = 0
+        while True:
+            self.wake.wait()
+            time.sleep(WRITE_BATCH_SECONDS)  # let a burst of saves coalesce into one flush
+            self.wake.clear()
+            try:
+                self.flush()
+                delay = 0
+            except Exception as e:
+                delay = min(max(delay * 2, 1), WRITE_MAX_BACKOFF)
+                rate_limited = getattr(e, 'code', None) == 429
+                self.status.update(error="rate limited" if rate_limited else str(e)[:120], retry_at=time.time() + delay)
+                if not rate_limited: self.store.reset()
+                time.sleep(delay)
+                self.wake.set()
+
+@st.cache_resource
+def write_queue():
+    """The process-wide writer for backends that want one (Sheets); None for the local SQLite store."""
+    store = get_storage()
+    if not store.write_behind: return None
+    return WriteBehind(store, local_path("HEALTHOS_QUEUE_PATH", "WRITE_QUEUE_PATH", WRITE_QUEUE_FILE))
+
+def sync_status_line():
+    store = get_storage()
+    if store.name == "mirror":
+        s = store.sync_state()
+        last = f"last synced {s['last_pull'][11:]}" if s['last_pull'] else "never synced"
+        if s['error']: return f"⚠️ Offline, showing the local copy · {last} · {s['pending']} change(s) to push ({s['error']})"
+        if s['pending']: return f"⏳ Pushing {s['pending']} change(s)... · {last}"
+        return f"✓ Synced with Google Sheets · {last}"
+    q = write_queue()
+    if q is None: return None
+    n, s = len(q.pending()), q.status
+    queued = sum(v['queued'] for v in sheets_quota().usage().values())
+    if queued: return f"⏳ Sheets quota reached, {queued} request(s) waiting · {n} change(s) pending"
+    if n and s['error']: return f"⚠️ {n} change(s) not synced yet, retrying in {max(0, int(s['retry_at'] - time.time()))}s ({s['error']})"
+    if n: return f"⏳ Syncing {n} change(s)..."
+    if s['last_flush']: return f"✓ All changes saved · {s['last_flush']:%H:%M:%S}"
+    return None
+
+def load_local_master():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    master_path = os.path.join(current_dir, MASTER_FILE_LOCAL)
+    if os.path.exists(master_path): return pd.read_csv(master_path)
+    return pd.DataFrame(columns=["Biomarker", "Fuzzy Match Keywords", "Standard Range", "Optimal Min", "Optimal Max", "Unit", "Plain-English Meaning"])
+
+def master_checksum(master):
+    return hashlib.sha1(pd.util.hash_pandas_object(master, index=False).values.tobytes() + "|".join(master.columns).encode()).hexdigest()
+
+# Each dataset is cached under its own version key; a write bumps only the version it touched, so
+# e.g. a profile save never costs a Results reload. Stale keys age out through ttl/max_entries.
+DATASETS = ("master", "results", "profile")
+
+@st.cache_resource
+def dataset_versions():
+    return {"lock": threading.Lock(), **{name: 0 for name in DATASETS}}
+
+def current_versions():
+    v = dataset_versions()
+    with v['lock']: return {name: v[name] for name in DATASETS}
+
+def invalidate_datasets(*names):
+    v = dataset_versions()
+    with v['lock']:
+        for name in names: v[name] += 1
+
+@st.cache_data(ttl=MASTER_CACHE_SECONDS, max_entries=4)
+def load_master(version=0):
+    """Master barely changes, so it lives far longer than Results/Profile; attrs['checksum'] identifies its content."""
+    return normalize_master(get_storage().read_master())
+
+@st.cache_data(ttl=MASTER_CHECK_SECONDS, max_entries=1)
+def master_source_checksum():
+    """Checksum of Master as stored right now; one read per MASTER_CHECK_SECONDS for the whole process."""
+    return normalize_master(get_storage().read_master()).attrs['checksum']
+
+def normalize_master(master):
+    if master is None or master.empty: master = load_local_master()
+    master = master.fillna("")
+    if 'Fuzzy Match Keywords' in master.columns: master['Fuzzy Match Keywords'] = master['Fuzzy Match Keywords'].astype(str)
+    if 'Unit' in master.columns: master['Unit'] = master['Unit'].fillna("")
+    master.attrs['checksum'] = master_checksum(master)
+    return master
+
+def _with_script_ctx(fn, ctx):
+    def run(*args):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+    return run
+
+@st.cache_data(ttl=10, max_entries=4)
+def load_results_index(version, master_version):
+    return get_storage().read_results_index(lambda: load_master(master_version))
+
+@st.cache_data(ttl=10, max_entries=16)
+def load_results(version, master_version, dates=None):
+    return get_storage().read_results(lambda: load_master(master_version), dates)
+
+@st.cache_data(ttl=10, max_entries=4)
+def load_profile(version):
+    return get_storage().read_profile()
 
-@st.cache_data(ttl=10)
 def load_data():
-    client = get_google_sheet_client()
-    if not client: return None, None, {}, "Auth Failed"
+    """
+    Master, the Results index and Profile, fetched concurrently alongside the Master checksum check;
+    cold-load time is the slowest read, not the sum. Result rows are read per page through load_results_window.
+    """
+    store, ctx, v = get_storage(), get_script_run_ctx(), current_versions()
     try:
-        sh = client.open(SHEET_NAME)
-        try:
-            ws_master = sh.worksheet("Master")
-            m_data = ws_master.get_all_values()
-            if len(m_data) > 1: master = pd.DataFrame(m_data[1:], columns=m_data[0])
-            else: raise Exception("Empty")
-        except:
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            master_path = os.path.join(current_dir, MASTER_FILE_LOCAL)
-            if os.path.exists(master_path): master = pd.read_csv(master_path)
-            else: master = pd.DataFrame(columns=["Biomarker", "Fuzzy Match Keywords", "Standard Range", "Optimal Min", "Optimal Max", "Unit", "Plain-English Meaning"])
-        master = master.fillna("")
-        if 'Fuzzy Match Keywords' in master.columns: master['Fuzzy Match Keywords'] = master['Fuzzy Match Keywords'].astype(str)
-        if 'Unit' in master.columns: master['Unit'] = master['Unit'].fillna("")
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            f_master = pool.submit(_with_script_ctx(load_master, ctx), v['master'])
+            f_profile = pool.submit(_with_script_ctx(load_profile, ctx), v['profile'])
+            f_index = pool.submit(_with_script_ctx(load_results_index, ctx), v['results'], v['master'])
+            f_check = pool.submit(_with_script_ctx(master_source_checksum, ctx))
+            master, index, profile = f_master.result(), f_index.result(), f_profile.result()
+        # Master is cached for an hour; an edit made directly in the sheet retires it within MASTER_CHECK_SECONDS
+        if f_check.result() != master.attrs.get('checksum'):
+            invalidate_datasets("master")
+            master = load_master(current_versions()['master'])
+        queue = write_queue()
+        if queue: index, profile = queue.overlay_index(index), queue.overlay_profile(profile)
+        index = index.assign(When=pd.to_datetime(index['Date'], errors='coerce'))
+        return master, index, profile, "OK"
+    except Exception as e:
+        store.reset()
+        return None, None, {}, str(e)
 
-        try:
-            ws_res = sh.worksheet("Results")
-            data = ws_res.get_all_values()
-            if not data: results = pd.DataFrame(columns=REQUIRED_COLUMNS)
-            else:
-                headers = data[0]
-                rows = data[1:]
-                results = pd.DataFrame(rows, columns=headers) if "Marker" in headers else pd.DataFrame(rows, columns=REQUIRED_COLUMNS[:len(rows[0])])
-        except gspread.exceptions.WorksheetNotFound:
-            ws_res = sh.add_worksheet("Results", 1000, 10)
-            ws_res.append_row(REQUIRED_COLUMNS)
-            results = pd.DataFrame(columns=REQUIRED_COLUMNS)
-        for col in REQUIRED_COLUMNS:
-            if col not in results.columns: results[col] = ""
+def load_results_window(results_index, when=None):
+    """Prepared Results rows for the index dates whose When is in `when` (all dates when None)."""
+    v = current_versions()
+    dates = None if when is None else tuple(sorted(results_index.loc[results_index['When'].isin(when), 'Date']))
+    results = load_results(v['results'], v['master'], dates)
+    queue = write_queue()
+    if queue: results = queue.overlay_results(results, load_master(v['master']), dates)
+    return results
 
-        try:
-            ws_prof = sh.worksheet("Profile")
-            p_data = ws_prof.get_all_values()
-            profile = {r[0]: r[1] for r in p_data if len(r) >= 2}
-        except: profile = {}
-
-        if not results.empty:
-            results['Date'] = pd.to_datetime(results['Date'], errors='coerce')
-            results = results.dropna(subset=['Date'])
-            results = results.dropna(subset=['Value'])
-            results = results[results['Value'].astype(str).str.strip() != ""]
-            results['NumericValue'] = pd.to_numeric(results['Value'], errors='coerce')
-            
-        return master, results, profile, "OK"
-    except Exception as e: return None, None, {}, str(e)
+def results_version():
+    """Identifies what load_results_window(results_index) serves: the stored versions plus any queued, unflushed saves."""
+    v, queue = current_versions(), write_queue()
+    return v['results'], v['master'], tuple(i for i, k, _ in queue.pending() if k.startswith("results:")) if queue else ()
 
 def smart_save_to_sheet(new_df):
-    client = get_google_sheet_client()
-    sh = client.open(SHEET_NAME)
-    try: ws = sh.worksheet("Results")
-    except: ws = sh.add_worksheet("Results", 1000, 10)
-    existing_data = ws.get_all_values()
-    if not existing_data:
-        ws.append_row(REQUIRED_COLUMNS)
-        existing_df = pd.DataFrame(columns=REQUIRED_COLUMNS)
-    else:
-        headers = existing_data[0]
-        rows = existing_data[1:]
-        existing_df = pd.DataFrame(rows, columns=headers)
     for col in REQUIRED_COLUMNS:
         if col not in new_df.columns: new_df[col] = ""
     new_df = new_df[REQUIRED_COLUMNS].copy()
     new_df['Date'] = new_df['Date'].astype(str)
     target_dates = new_df['Date'].unique()
-    final_df = existing_df[~existing_df['Date'].isin(target_dates)]
-    final_df = pd.concat([final_df, new_df], ignore_index=True)
-    final_df = final_df.fillna("").astype(str)
-    ws.clear()
-    ws.append_row(REQUIRED_COLUMNS)
-    ws.append_rows(final_df.values.tolist())
-    st.cache_data.clear()
+    queue = write_queue()
+    if queue: queue.enqueue([(f"results:{d}", new_df[new_df['Date'] == d].fillna("").astype(str).values.tolist()) for d in target_dates])
+    else:
+        get_storage().save_results(new_df)
+        invalidate_datasets("results")
     if len(target_dates) > 0: st.session_state['auto_select_date'] = target_dates[0]
 
 def save_profile_to_sheet(new_profile):
-    client = get_google_sheet_client()
-    sh = client.open(SHEET_NAME)
-    try: ws = sh.worksheet("Profile")
-    except: ws = sh.add_worksheet(title="Profile", rows=100, cols=2)
-    rows = [[k, str(v)] for k, v in new_profile.items()]
-    ws.clear()
-    ws.update(values=rows)
-    st.cache_data.clear()
+    queue = write_queue()
+    if queue: queue.enqueue([("profile", {k: str(v) for k, v in new_profile.items()})])
+    else:
+        get_storage().save_profile(new_profile)
+        invalidate_datasets("profile")
 
 def clear_database():
-    client = get_google_sheet_client()
-    sh = client.open(SHEET_NAME)
-    ws = sh.worksheet("Results")
-    ws.clear()
-    ws.append_row(REQUIRED_COLUMNS)
-    st.cache_data.clear()
+    queue = write_queue()
+    if queue: queue.enqueue([("results:clear", None)])
+    else:
+        get_storage().clear_results()
+        invalidate_datasets("results")
 
 # --- 4. ENGINE ---
-def process_uploaded_image(uploaded_file):
-    try:
-        mime_type = uploaded_file.type
-        file_data = {"mime_type": mime_type, "data": uploaded_file.getvalue()}
-        prompt = f"""Act as a Medical Document Scanner. EXTRACT structured data.
+# --- DISK CACHE ---
+CACHE_FILE_LOCAL = "healthos_cache.db"
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+class DiskCache:
+    """
+    Persistent (namespace, key) -> value store: values are pickled into one SQLite file, the total is kept
+    under max_bytes by evicting least-recently-used entries, and entries may carry a TTL. `tag` records the
+    version an entry was computed with (e.g. the prompt) so stale generations can be dropped in one go.
+    """
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS entries (namespace TEXT NOT NULL, key TEXT NOT NULL, tag TEXT NOT NULL,
+                value BLOB NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL, expires REAL, PRIMARY KEY (namespace, key))""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+
+    def get(self, namespace, key):
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT value, expires FROM entries WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+            if row is None: return None
+            if row[1] is not None and row[1] < time.time():
+                self.conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+                return None
+            self.conn.execute("UPDATE entries SET used = ? WHERE namespace = ? AND key = ?", (time.time(), namespace, key))
+        return pickle.loads(row[0])
+
+    def put(self, namespace, key, value, tag="", ttl=None):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes: return
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (namespace, key, tag, blob, len(blob), now, now + ttl if ttl else None))
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                # Oldest-used first until back under the budget
+                for ns, k, size in self.conn.execute("SELECT namespace, key, size FROM entries ORDER BY used").fetchall():
+                    if total <= self.max_bytes: break
+                    self.conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (ns, k))
+                    total -= size
+
+    def drop_stale(self, namespace, current_tag):
+        with self.lock, self.conn: self.conn.execute("DELETE FROM entries WHERE namespace = ? AND tag != ?", (namespace, current_tag))
+
+    def clear(self, namespace=None):
+        with self.lock, self.conn:
+            if namespace is None: self.conn.execute("DELETE FROM entries")
+            else: self.conn.execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+
+@st.cache_resource
+def disk_cache():
+    cache = DiskCache(local_path("HEALTHOS_CACHE_PATH", "CACHE_PATH", CACHE_FILE_LOCAL), CACHE_MAX_BYTES)
+    cache.drop_stale("extract", EXTRACTION_PROMPT_VERSION)
+    cache.drop_stale("deepdive", DEEP_DIVE_PROMPT_VERSION)
+    return cache
+
+EXTRACTION_PROMPT = """Act as a Medical Document Scanner. EXTRACT structured data.
         
         CRITICAL RULES:
         1. **MANDATORY SEARCH:** Look closely for these markers:
@@ -274,20 +1119,311 @@ def process_uploaded_image(uploaded_file):
            - Extract 'Marker', 'Value', 'Unit'.
         
         OUTPUT: Clean CSV with headers: Marker, Value, Unit, Flag, Date"""
-        
-        response = model.generate_content([prompt, file_data], safety_settings=safety_settings)
-        if not response.parts: return None, "AI empty."
-        csv_text = response.text.replace('```csv', '').replace('```', '').strip()
-        df = pd.read_csv(io.StringIO(csv_text), on_bad_lines='skip')
-        df.columns = [c.strip() for c in df.columns]
-        rename_map = {'Test': 'Marker', 'Result': 'Value', 'Results': 'Value', 'Units': 'Unit', 'Ref Range': 'Flag', 'Reference': 'Flag'}
-        new_cols = {c: rename_map[k] for c in df.columns for k in rename_map if c.lower() == k.lower()}
-        df = df.rename(columns=new_cols)
-        if 'Marker' not in df.columns or 'Value' not in df.columns: return None, "Structure failed."
-        df['Value'] = df['Value'].astype(str).str.extract(r'(\d+\.?\d*)')[0]
-        df = df.dropna(subset=['Value'])
-        df['Source'] = 'Lab Report'
-        return df, "Success"
+# Any edit to the prompt changes its version, which retires every extraction cached under the old one
+EXTRACTION_PROMPT_VERSION = hashlib.sha256(EXTRACTION_PROMPT.encode()).hexdigest()[:16]
+
+EXTRACT_MAX_INFLIGHT = 4  # concurrent page requests per document
+EXTRACT_PAGE_RETRIES = 2
+EXTRACT_RETRY_BACKOFF = 2  # seconds before the first re-send, doubled each round
+
+def split_pdf_pages(data):
+    """One standalone PDF per page; [data] when pypdf is missing or the file is not a readable multi-page PDF."""
+    if PdfReader is None: return [data]
+    try: reader = PdfReader(io.BytesIO(data))
+    except Exception: return [data]
+    if len(reader.pages) <= 1: return [data]
+    pages = []
+    for page in reader.pages:
+        writer, buf = PdfWriter(), io.BytesIO()
+        writer.add_page(page)
+        writer.write(buf)
+        pages.append(buf.getvalue())
+    return pages
+
+def extract_part(data, mime_type):
+    """One model call for a whole file or a single page -> (DataFrame or None, status)."""
+    # Content-addressed: the same file (or page) re-uploaded under any name is served from disk
+    cache_key = f"{hashlib.sha256(data).hexdigest()}:{EXTRACTION_PROMPT_VERSION}"
+    cached = disk_cache().get("extract", cache_key)
+    if cached is not None: return cached, "Success (cached)"
+    response = model.generate_content([EXTRACTION_PROMPT, {"mime_type": mime_type, "data": data}], safety_settings=safety_settings)
+    if not response.parts: return None, "AI empty."
+    csv_text = response.text.replace('```csv', '').replace('```', '').strip()
+    df = pd.read_csv(io.StringIO(csv_text), on_bad_lines='skip')
+    df.columns = [c.strip() for c in df.columns]
+    rename_map = {'Test': 'Marker', 'Result': 'Value', 'Results': 'Value', 'Units': 'Unit', 'Ref Range': 'Flag', 'Reference': 'Flag'}
+    new_cols = {c: rename_map[k] for c in df.columns for k in rename_map if c.lower() == k.lower()}
+    df = df.rename(columns=new_cols)
+    if 'Marker' not in df.columns or 'Value' not in df.columns: return None, "Structure failed."
+    df['Value'] = df['Value'].astype(str).str.extract(r'(\d+\.?\d*)')[0]
+    df = df.dropna(subset=['Value'])
+    df['Source'] = 'Lab Report'
+    disk_cache().put("extract", cache_key, df, tag=EXTRACTION_PROMPT_VERSION)
+    return df, "Success"
+
+def extract_pages(pages, mime_type):
+    """
+    Pages go out concurrently, at most EXTRACT_MAX_INFLIGHT at a time; each round re-sends only the pages
+    that raised, after an exponential backoff so a rate limit has time to clear. An API error that outlasts the retries fails the upload (finished pages stay cached), while
+    a page the model cannot tabulate (cover sheet, notes) is skipped. Results are merged on (Marker, Date).
+    """
+    frames, errors, todo, ctx = {}, {}, list(range(len(pages))), get_script_run_ctx()
+    for attempt in range(1 + EXTRACT_PAGE_RETRIES):
+        if attempt: time.sleep(EXTRACT_RETRY_BACKOFF * 2 ** (attempt - 1))
+        with ThreadPoolExecutor(max_workers=EXTRACT_MAX_INFLIGHT) as pool:
+            futures = {i: pool.submit(_with_script_ctx(extract_part, ctx), pages[i], mime_type) for i in todo}
+        for i, f in futures.items():
+            try: df, status = f.result()
+            except Exception as e: df, status = None, e
+            if df is not None: frames[i] = df
+            else: errors[i] = status
+        todo = [i for i in todo if i not in frames and isinstance(errors[i], Exception)]
+        if not todo: break
+    if todo: return None, f"Page {todo[0] + 1} of {len(pages)} failed: {errors[todo[0]]}"
+    skipped = sorted(i for i in errors if i not in frames)
+    if not frames: return None, errors[skipped[0]]
+
+    df = pd.concat([frames[i] for i in sorted(frames)], ignore_index=True)
+    if 'Date' not in df.columns: df['Date'] = None
+    # Continuation pages often lack the report date: use the one the other pages agree on
+    dates = df['Date'].dropna().astype(str).str.strip()
+    dates = dates[dates != ""]
+    if not dates.empty: df['Date'] = df['Date'].where(df['Date'].notna() & (df['Date'].astype(str).str.strip() != ""), dates.mode()[0])
+    df['Marker'] = df['Marker'].astype(str).str.strip()
+    df = df.drop_duplicates(subset=['Marker', 'Date'], keep='first').reset_index(drop=True)
+    status = "Success" if not skipped else f"Success (skipped unreadable page {', '.join(str(i + 1) for i in skipped)})"
+    return df, status
+
+# --- TEXT-LAYER FAST PATH ---
+# Digitally generated PDFs carry their own text. Result lines are recognised deterministically: the text
+# before the first standalone number must start with a master keyword (same NON rule as fuzzy_match, no
+# fuzzy ratio). Too little text (a scan) or too few matched rows sends the file to the model instead.
+TEXT_MIN_CHARS_PER_PAGE = 200
+TEXT_MIN_MARKERS = 5
+_TEXT_NUMBER = re.compile(r'(?<![\w.])[<>]?(\d+(?:\.\d+)?)(?![\w.])')
+_TEXT_DATES = [
+    (re.compile(r'\b(\d{4}-\d{2}-\d{2})\b'), False),
+    (re.compile(r'\b(\d{1,2}[/.-]\d{1,2}[/.-]\d{4})\b'), True),
+    (re.compile(r'\b(\d{1,2}[\s-][A-Za-z]{3,9}[\s-]\d{4})\b'), True),
+]
+_TEXT_FLAGS = {"H": "H", "HIGH": "H", "L": "L", "LOW": "L", "*": "*"}
+_TEXT_BIRTH = re.compile(r'(?:date\s+of\s+birth|birth\s*date|birth|\bborn\b|\bDOB\b)\W*', re.I)
+
+def text_layer_keywords(master):
+    keys = {smart_clean(k) for kws in master['Fuzzy Match Keywords'] for k in str(kws).split(",")}
+    return sorted((k for k in keys if k), key=len, reverse=True)
+
+def text_label_matches(label, keys):
+    lab = smart_clean(label)
+    for key in keys:
+        if ("NON" in lab) != ("NON" in key): continue
+        if key == lab or (len(key) > 2 and lab.startswith(key)): return True
+    return False
+
+def _without_birth_date(line):
+    """The line minus any birth-date label and the date right after it ("DOB: 12/05/1980")."""
+    m = _TEXT_BIRTH.search(line)
+    while m:
+        rest = line[m.end():]
+        d = next((d for d in (p.match(rest) for p, _ in _TEXT_DATES) if d), None)
+        line = line[:m.start()] + " " + (rest[d.end():] if d else rest)
+        m = _TEXT_BIRTH.search(line)
+    return line
+
+def find_report_date(text):
+    """Collection/report date as YYYY-MM-DD: lines naming a date come first, birth dates are ignored."""
+    lines = [_without_birth_date(l) for l in text.splitlines()]
+    preferred = [l for l in lines if re.search(r'collect|report|sample|received|date', l, re.I)]
+    for line in preferred + lines:
+        for pattern, dayfirst in _TEXT_DATES:
+            m = pattern.search(line)
+            if m:
+                d = pd.to_datetime(m.group(1), dayfirst=dayfirst, errors='coerce')
+                if pd.notna(d): return d.strftime('%Y-%m-%d')
+    return None
+
+def parse_text_layer(text, keys):
+    rows = []
+    for line in text.splitlines():
+        line = line.strip()
+        for m in _TEXT_NUMBER.finditer(line):
+            words, flag = line[:m.start()].split(), ""
+            # "Triglycerides H 2.3": a flag printed before the value is not part of the name
+            while words and words[-1].strip(":").upper() in _TEXT_FLAGS: flag = _TEXT_FLAGS[words.pop().strip(":").upper()]
+            label = " ".join(words).strip(" :\t.-")
+            if sum(c.isalpha() for c in label) < 2: continue
+            if not text_label_matches(label, keys): break
+            value, tokens = m.group(1), line[m.end():].split()
+            if tokens and tokens[0].upper() in _TEXT_FLAGS: flag = _TEXT_FLAGS[tokens.pop(0).upper()]
+            unit = tokens.pop(0) if tokens and not _TEXT_NUMBER.fullmatch(tokens[0]) and tokens[0][0] not in "-(<>" else ""
+            # "55 % 4.50 10^9/L": keep the absolute count, not the percentage
+            if unit == "%" and tokens and _TEXT_NUMBER.fullmatch(tokens[0]):
+                value = _TEXT_NUMBER.fullmatch(tokens.pop(0)).group(1)
+                unit = tokens.pop(0) if tokens and not _TEXT_NUMBER.fullmatch(tokens[0]) and tokens[0][0] not in "-(<>" else ""
+            # Otherwise the flag may follow the reference range: "4.2 mmol/L 0.0 - 3.0 H"
+            if not flag: flag = next((_TEXT_FLAGS[t.upper()] for t in tokens if t.upper() in _TEXT_FLAGS), "")
+            rows.append({"Marker": label, "Value": value, "Unit": unit, "Flag": flag})
+            break
+    return pd.DataFrame(rows, columns=['Marker', 'Value', 'Unit', 'Flag'])
+
+def pdf_text(data):
+    """The PDF's own text, or None for scans and unreadable files."""
+    if PdfReader is None: return None
+    try:
+        reader = PdfReader(io.BytesIO(data))
+        text = "\n".join(page.extract_text() or "" for page in reader.pages)
+    except Exception: return None
+    if len(text.strip()) < TEXT_MIN_CHARS_PER_PAGE * max(len(reader.pages), 1): return None
+    return text
+
+def parse_result_table(text, master):
+    date = find_report_date(text)
+    df = parse_text_layer(text, text_layer_keywords(master))
+    if date is None or df['Marker'].nunique() < TEXT_MIN_MARKERS: return None
+    df['Date'] = date
+    return df
+
+# --- LAYOUT TEMPLATES ---
+# Deterministic parsers for layouts we see again and again, consulted before the model. Each entry pairs a
+# cheap fingerprint (CSV header tokens, or the PDF text) with a parser that returns the frame the model path
+# returns; a parser may return None to fall through. More specific layouts go first, catch-alls last.
+LAB_COLUMNS = ['Marker', 'Value', 'Unit', 'Flag', 'Date']
+CSV_TYPES = {"text/csv", "application/csv", "application/vnd.ms-excel"}
+
+def csv_header(data):
+    first = data[:4096].decode("utf-8-sig", errors="replace").splitlines()[:1]
+    return [h.strip().strip('"').strip().lower() for h in re.split(r'[,;\t]', first[0])] if first else []
+
+def read_csv_bytes(data):
+    return pd.read_csv(io.BytesIO(data), sep=None, engine="python", dtype=str, encoding="utf-8-sig")
+
+def finish_layout_frame(df):
+    df = df.loc[:, ~df.columns.duplicated()].copy()
+    for c in LAB_COLUMNS:
+        if c not in df.columns: df[c] = ""
+    df = df[LAB_COLUMNS]
+    df['Value'] = df['Value'].astype(str).str.extract(r'(\d+\.?\d*)')[0]
+    df['Date'] = df['Date'].apply(lambda d: find_report_date(str(d)))
+    df = df.dropna(subset=['Value', 'Date'])
+    df['Marker'] = df['Marker'].astype(str).str.strip()
+    df[['Unit', 'Flag']] = df[['Unit', 'Flag']].fillna("").astype(str).apply(lambda s: s.str.strip())
+    return df[df['Marker'] != ""].reset_index(drop=True)
+
+def csv_template(layout):
+    """A LAYOUT_TEMPLATES entry for one of the CSV layouts shared with clinical.py (lab_units.CSV_LAYOUTS)."""
+    return {"name": layout["name"], "kind": "csv", "match": lambda header, master: layout["match"](header),
+            "parse": lambda data, master: finish_layout_frame(layout["parse"](read_csv_bytes(data)))}
+
+LAYOUT_TEMPLATES = [
+    *map(csv_template, CSV_LAYOUTS),
+    {"name": "text layer", "kind": "pdf", "match": lambda text, master: True, "parse": parse_result_table},
+]
+
+def template_extract(data, mime_type, master):
+    """(DataFrame, status) from the first template whose fingerprint matches, or None when the model has to read it."""
+    if master is None or master.empty: return None
+    if mime_type == "application/pdf":
+        kind, payload = "pdf", pdf_text(data)
+        if payload is None: return None
+        probe = payload
+    elif mime_type in CSV_TYPES: kind, payload, probe = "csv", data, csv_header(data)
+    else: return None
+    for template in LAYOUT_TEMPLATES:
+        if template["kind"] != kind or not template["match"](probe, master): continue
+        try: df = template["parse"](payload, master)
+        except Exception: df = None
+        if df is not None and not df.empty:
+            df['Source'] = 'Lab Report'
+            return df.drop_duplicates(subset=['Marker', 'Date']).reset_index(drop=True), f"Success ({template['name']})"
+    return None
+
+# --- IMAGE PREPROCESSING ---
+# Phone photos arrive at 5-12 MB. Before they go to the model they are turned upright, made grayscale,
+# cropped to the printed area and scaled to about IMAGE_TARGET_DPI for an A4 page, then re-encoded as JPEG.
+# Scanned PDF pages (images, no text layer) get the same grayscale/scale/JPEG treatment, minus the crop: the
+# page draws each image into a fixed box.
+# The output is deterministic, so the extraction cache still hits on a re-upload of the same photo.
+IMAGE_TARGET_DPI = 200
+IMAGE_MAX_SIDE = round(11.69 * IMAGE_TARGET_DPI)  # long edge of A4 in inches
+IMAGE_JPEG_QUALITY = 85
+IMAGE_PAPER_LEVEL = 200  # lighter than this counts as blank paper when cropping
+IMAGE_CROP_PAD = 20
+
+def preprocess_image(data, mime_type):
+    """(bytes, mime type) ready for the model; the original when it is not an image or would not shrink."""
+    if Image is None or not mime_type.startswith("image/"): return data, mime_type
+    try:
+        img = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert("L")
+        box = img.point(lambda p: 255 if p < IMAGE_PAPER_LEVEL else 0).getbbox()
+        if box:
+            l, t, r, b = box
+            img = img.crop((max(l - IMAGE_CROP_PAD, 0), max(t - IMAGE_CROP_PAD, 0), min(r + IMAGE_CROP_PAD, img.width), min(b + IMAGE_CROP_PAD, img.height)))
+        img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    except Exception: return data, mime_type
+    out = buf.getvalue()
+    return (out, "image/jpeg") if len(out) < len(data) else (data, mime_type)
+
+def preprocess_pdf_page(page):
+    """A one-page PDF whose images are scaled and re-encoded like photos when it is a scan (no text layer)."""
+    if PdfReader is None or Image is None: return page
+    try:
+        writer = PdfWriter(clone_from=PdfReader(io.BytesIO(page)))
+        if len(writer.pages) != 1: return page
+        p = writer.pages[0]
+        if p.extract_text().strip() or not p.images: return page
+        # Same pixel budget as a photo of the page: IMAGE_TARGET_DPI over the page's long edge (points are 1/72 in)
+        max_side = round(max(float(p.mediabox.width), float(p.mediabox.height)) / 72 * IMAGE_TARGET_DPI)
+        for img in p.images:
+            pixels = img.image.convert("L")
+            pixels.thumbnail((max_side, max_side), Image.LANCZOS)
+            img.replace(pixels, quality=IMAGE_JPEG_QUALITY)
+        buf = io.BytesIO()
+        writer.write(buf)
+    except Exception: return page
+    out = buf.getvalue()
+    return out if len(out) < len(page) else page
+
+def frame_fingerprint(page):
+    """
+    What the model would see on a one-page PDF: its text layer plus the decoded pixels of its images, so the
+    same sheet stored twice under another encoding or page wrapper matches. Falls back to the bytes.
+    """
+    if PdfReader is None or Image is None: return hashlib.sha256(page).hexdigest()
+    try:
+        p = PdfReader(io.BytesIO(page)).pages[0]
+        text, images = " ".join(p.extract_text().split()), p.images
+        if not text and not images: return hashlib.sha256(page).hexdigest()  # vector-only: nothing decodable to compare
+        h = hashlib.sha256(text.encode())
+        for img in images:
+            pixels = img.image.convert("L")
+            h.update(f"{pixels.size}".encode())
+            h.update(pixels.tobytes())
+        return h.hexdigest()
+    except Exception: return hashlib.sha256(page).hexdigest()
+
+def unique_frames(pages):
+    """Drop repeated pages (a scan that fed the same sheet twice, a report merged with itself), keeping order."""
+    seen, unique = set(), []
+    for page in pages:
+        key = frame_fingerprint(page)
+        if key not in seen:
+            seen.add(key)
+            unique.append(page)
+    return unique
+
+def process_uploaded_image(uploaded_file, master=None):
+    try:
+        data, mime_type = uploaded_file.getvalue(), uploaded_file.type
+        if uploaded_file.name.lower().endswith(".csv"): mime_type = "text/csv"
+        fast = template_extract(data, mime_type, master)
+        if fast is not None: return fast
+        if mime_type in CSV_TYPES: return extract_part(data, "text/plain")  # unknown layout: let the model read it
+        data, mime_type = preprocess_image(data, mime_type)
+        pages = unique_frames([preprocess_pdf_page(p) for p in split_pdf_pages(data)]) if mime_type == "application/pdf" else [data]
+        if len(pages) == 1: return extract_part(pages[0], mime_type)
+        return extract_pages(pages, mime_type)
     except Exception as e: return None, str(e)
 
 # --- 5. LOGIC ---
@@ -295,6 +1431,14 @@ def smart_clean(marker):
     m = str(marker).upper()
     return re.sub(r'^[SPBU]-\s*', '', m.replace("SERUM", "").replace("PLASMA", "").replace("BLOOD", "").replace("TOTAL", "").strip())
 
+def apply_unit_conversions(df, master):
+    """Column-wise: NumericValue becomes the master-unit value, raw Value/Unit are kept, CanonicalUnit is added."""
+    matches = {m: fuzzy_match(m, master) for m in df['Marker'].dropna().unique()}
+    biomarker = df['Marker'].map({m: r['Biomarker'] for m, r in matches.items() if r is not None})
+    target = df['Marker'].map({m: str(r['Unit']) for m, r in matches.items() if r is not None})
+    df['NumericValue'], df['CanonicalUnit'] = canonicalize(df['Value'], df['Unit'], biomarker, target)
+    return df
+
 CATEGORY_MAP = {
     "❤️ Lipids": ["CHOLESTEROL", "HDL", "LDL", "TRIG", "APOB", "LIPOPROTEIN", "NON-HDL", "RATIO", "HOMOCYST", "CRP", "HS-CRP"],
     "🧬 Hormones": ["TESTOSTERONE", "OESTRADIOL", "PROGESTERONE", "DHEA", "SHBG", "FSH", "LH", "CORTISOL", "PROLACTIN"],
@@ -329,19 +1473,62 @@ def unify_marker_names(marker):
     if "PLATELET" in clean: return "Platelets"
     return marker.title()
 
+class FuzzyMatcher:
+    """
+    fuzzy_match compiled for one master: keywords cleaned once and split by the NON rule, a prefix trie that
+    finds the first keyword (in master order) equal to or starting the name, and a memo per raw name. Scores
+    fall back to SequenceMatcher over each distinct keyword once; a repeat can never beat its first
+    occurrence under the strict comparison, so the answer is the same as the row-by-row scan.
+    """
+    def __init__(self, master):
+        self.rows = [row for _, row in master.iterrows()]
+        self.parts = {True: ({}, {}), False: ({}, {})}  # NON? -> (trie, first position of each keyword)
+        for pos, (i, key) in enumerate((i, smart_clean(k)) for i, row in enumerate(self.rows) for k in str(row['Fuzzy Match Keywords']).split(",")):
+            trie, first = self.parts["NON" in key]
+            if key in first: continue
+            first[key] = (pos, i)
+            node = trie
+            for ch in key: node = node.setdefault(ch, {})
+            node[None] = first[key]
+        self.memo = {}
+
+    def match(self, marker):
+        if marker in self.memo: return self.memo[marker]
+        lab_clean = smart_clean(marker)
+        trie, first = self.parts["NON" in lab_clean]
+        hits, node = [], trie
+        for depth in range(len(lab_clean) + 1):
+            if None in node and (depth > 2 or depth == len(lab_clean)): hits.append(node[None])
+            if depth == len(lab_clean) or lab_clean[depth] not in node: break
+            node = node[lab_clean[depth]]
+        if hits: best = self.rows[min(hits)[1]]
+        else:
+            best, best_score = None, 0.0
+            for key, (_, i) in first.items():
+                score = SequenceMatcher(None, lab_clean, key).ratio()
+                if score > best_score: best_score, best = score, self.rows[i]
+            if best_score <= 0.60: best = None
+        self.memo[marker] = best
+        return best
+
+@st.cache_resource(max_entries=4)
+def fuzzy_matcher(checksum, _master): return FuzzyMatcher(_master)
+
+# id(master) -> (weak reference, checksum). attrs are not trusted here: pandas copies them onto filtered,
+# copied and filled frames, which would then reuse the full master's matcher.
+_matcher_checksums = {}
+
+def matcher_checksum(master):
+    """master_checksum computed once per frame object; the entry goes when the frame does."""
+    key = id(master)
+    entry = _matcher_checksums.get(key)
+    if entry is None or entry[0]() is not master:
+        entry = (weakref.ref(master, lambda _: _matcher_checksums.pop(key, None)), master_checksum(master))
+        _matcher_checksums[key] = entry
+    return entry[1]
+
 def fuzzy_match(marker, master):
-    lab_clean = smart_clean(marker)
-    best_row, best_score = None, 0.0
-    for _, row in master.iterrows():
-        keywords = [smart_clean(k) for k in str(row['Fuzzy Match Keywords']).split(",")]
-        for key in keywords:
-            if "NON" in lab_clean and "NON" not in key: continue
-            if "NON" not in lab_clean and "NON" in key: continue
-            if key == lab_clean: return row
-            if lab_clean.startswith(key) and len(key) > 2: return row
-            score = SequenceMatcher(None, lab_clean, key).ratio()
-            if score > best_score: best_score, best_row = score, row
-    return best_row if best_score > 0.60 else None
+    return fuzzy_matcher(matcher_checksum(master), master).match(marker)
 
 def parse_range(range_str):
     if pd.isna(range_str): return 0,0
@@ -358,8 +1545,7 @@ def parse_range(range_str):
 def get_detailed_status(val, master_row, marker_name):
     try:
         clean_name = smart_clean(marker_name)
-        if "HBA1C" in clean_name and val > 20 and "%" in str(master_row['Unit']): val = (val * 0.0915) + 2.15
-        
+
         s_min, s_max = parse_range(master_row['Standard Range'])
         try: o_min = float(str(master_row['Optimal Min']).replace(',', '.'))
         except: o_min = 0.0
@@ -426,17 +1612,77 @@ def format_profile_for_ai(profile):
     - **Supplements:** {supps}
     - **User Narrative:** "{bio}" """
 
-def generate_deep_dive(marker, value, status, profile):
-    prompt = f"""You are HealthOS, a physiological coach. Explain '{marker}' (Level: {value}, Status: {status}).
-    *** CLIENT *** {format_profile_for_ai(profile)}
+DEEP_DIVE_PROMPT = """You are HealthOS, a physiological coach. Explain '{marker}' (Level: {value}, Status: {status}).
+    *** CLIENT *** {profile}
     *** TASK *** 1. Analogy. 2. Why it matters. 3. Analysis. 4. Fix (3 habits).
     TONE: Calm, educational."""
+DEEP_DIVE_PROMPT_VERSION = hashlib.sha256(DEEP_DIVE_PROMPT.encode()).hexdigest()[:16]
+DEEP_DIVE_TTL = 30 * 24 * 3600
+
+def value_bucket(value):
+    """Two significant figures: 5.43 and 5.38 share an explanation, 5.4 and 6.1 do not."""
+    try: return f"{float(f'{float(value):.2g}'):g}"
+    except (TypeError, ValueError): return str(value)
+
+def stream_model_text(prompt, unavailable):
+    """Model output chunk by chunk as it is generated (feed to st.write_stream); `unavailable` if nothing came back."""
+    empty = True
+    for chunk in model.generate_content(prompt, safety_settings=safety_settings, stream=True):
+        if chunk.parts:
+            empty = False
+            yield chunk.text
+    if empty: yield unavailable
+
+def generate_deep_dive(marker, value, status, profile, unit=""):
+    """Explanation chunks; a case explained before (any session, any restart) comes back whole from disk."""
+    # The prompt sees the bucketed value and the key hashes the exact profile text sent, so an entry shared
+    # by everyone in the bucket never quotes someone else's number
+    bucket, user_context = value_bucket(value), format_profile_for_ai(profile)
+    profile_hash = hashlib.sha256(user_context.encode()).hexdigest()[:16]
+    cache_key = f"{smart_clean(marker)}:{status}:{bucket}:{unit}:{profile_hash}:{DEEP_DIVE_PROMPT_VERSION}"
+    cached = disk_cache().get("deepdive", cache_key)
+    if cached is not None:
+        yield cached
+        return
+    prompt = DEEP_DIVE_PROMPT.format(marker=marker, value=f"{bucket} {unit}".strip(), status=status, profile=user_context)
+    text = ""
     try:
-        response = model.generate_content(prompt, safety_settings=safety_settings)
-        return response.text if response.parts else "Unavailable."
-    except: return "Unavailable."
+        for chunk in stream_model_text(prompt, ""):
+            text += chunk
+            yield chunk
+    except:
+        if not text: yield "Unavailable."
+        return  # a cut-off explanation is shown but never cached
+    if not text: yield "Unavailable."
+    else: disk_cache().put("deepdive", cache_key, text, tag=DEEP_DIVE_PROMPT_VERSION, ttl=DEEP_DIVE_TTL)
+
+RELATED_MARKERS = {"LDL": ["APOB", "LIPOPROTEIN"], "CHOLESTEROL": ["APOB"], "TRIGLYCERIDES": ["INSULIN"], "GLUCOSE": ["HBA1C"], "TESTOSTERONE": ["SHBG", "LH"], "TSH": ["T3", "T4"], "FERRITIN": ["IRON", "CRP"]}
 
-def generate_snapshot_report(df_view, date_str, profile, history_df):
+@st.cache_data(max_entries=4)
+def build_marker_index(version, _history_df):
+    """
+    One pass over history per results_version(); the frame itself is never hashed. 'latest': smart_clean(Marker)
+    -> most recent row. 'related': RELATED_MARKERS target -> most recent row among markers equal to or containing it.
+    """
+    view, related = {}, {}
+    if _history_df.empty: return {"latest": view, "related": related}
+    hist = _history_df.dropna(subset=['Date']).sort_values('Date', kind='stable')
+    clean = {m: smart_clean(m) for m in hist['Marker'].unique()}
+    for marker, date, value in zip(hist['Marker'], hist['Date'], hist['Value']):
+        view[clean[marker]] = {"Marker": marker, "Value": value, "Date": date}
+    # Targets are alphanumeric, so "target in key" can only hold inside one token of the key
+    tokens = {}
+    for key in view:
+        for tok in set(re.findall(r'[A-Z0-9]+', key)): tokens.setdefault(tok, []).append(key)
+    order = {k: i for i, k in enumerate(view)}
+    for target in dict.fromkeys(t for targets in RELATED_MARKERS.values() for t in targets):
+        keys = {k for tok, ks in tokens.items() if target in tok for k in ks}
+        if smart_clean(target) in view: keys.add(smart_clean(target))
+        if keys: related[target] = view[max(sorted(keys, key=order.get), key=lambda k: view[k]['Date'])]
+    return {"latest": view, "related": related}
+
+def generate_snapshot_report(df_view, date_str, profile, history_df, history_version):
+    """Report chunks as the model writes them."""
     current_date_obj = pd.to_datetime(date_str)
     past_labs = history_df[history_df['Date'] < current_date_obj]
     data_summary = ""
@@ -447,22 +1693,21 @@ def generate_snapshot_report(df_view, date_str, profile, history_df):
         marker = row['Marker']
         val_now = row['Value']
         status = row['Status']
-        line = f"- {marker}: {val_now} ({status})\n"
+        line = f"- {marker}: {val_now} {row['Unit']} ({status})\n"
         data_summary += line
         if status in ["OUT OF RANGE", "BORDERLINE"]:
             abnormal_markers_found.append(f"{marker} ({val_now})")
 
-    related_map = {"LDL": ["APOB", "LIPOPROTEIN"], "CHOLESTEROL": ["APOB"], "TRIGLYCERIDES": ["INSULIN"], "GLUCOSE": ["HBA1C"], "TESTOSTERONE": ["SHBG", "LH"], "TSH": ["T3", "T4"], "FERRITIN": ["IRON", "CRP"]}
+    related = build_marker_index(history_version, history_df)['related']
     connected_insights = ""
     for abnormal_entry in abnormal_markers_found:
         m_name = abnormal_entry.split(' (')[0]
         clean_abnormal = smart_clean(m_name)
-        for trigger_key, related_targets in related_map.items():
+        for trigger_key, related_targets in RELATED_MARKERS.items():
             if trigger_key in clean_abnormal:
                 for target in related_targets:
-                    match_in_history = history_df[history_df['Marker'].apply(lambda x: smart_clean(x) == smart_clean(target) or target in smart_clean(x))]
-                    if not match_in_history.empty:
-                        last_rel = match_in_history.sort_values('Date').iloc[-1]
+                    last_rel = related.get(target)
+                    if last_rel:
                         connected_insights += f"NOTE: {m_name} is flagged. But {last_rel['Marker']} was {last_rel['Value']} on {last_rel['Date'].strftime('%Y-%m-%d')}. USE THIS CONTEXT.\n"
 
     abnormal_list_str = ", ".join(abnormal_markers_found) if abnormal_markers_found else "None"
@@ -484,10 +1729,8 @@ def generate_snapshot_report(df_view, date_str, profile, history_df):
        * **D. Targeted Supplementation:** Specific non-prescription compounds.
        * **E. Follow-Up Testing:** Re-test plan.
     TONE: Calm, analytical, professional."""
-    try:
-        response = model.generate_content(prompt, safety_settings=safety_settings)
-        return response.text if response.parts else "AI Analysis Unavailable."
-    except Exception as e: return f"Error: {e}"
+    try: yield from stream_model_text(prompt, "AI Analysis Unavailable.")
+    except Exception as e: yield f"Error: {e}"
 
 def safe_parse_list(val):
     if not val: return []
@@ -496,9 +1739,68 @@ def safe_parse_list(val):
         return []
     except: return []
 
+# --- BACKGROUND JOBS ---
+# Model calls run off the script thread. A job drains one of the text generators above on a pool thread;
+# the page keeps its id in session state and polls it from a fragment, or follows it chunk by chunk, so a
+# report survives navigating away and prefetched deep dives are ready by the time Details is opened.
+# Prefetches get their own pool so they never queue in front of a report the user asked for.
+JOB_WORKERS = {INTERACTIVE: 2, BACKGROUND: 4}
+JOB_POLL_SECONDS = 1
+JOB_KEEP_SECONDS = 3600
+
+class JobRunner:
+    def __init__(self, workers):
+        self.pools = {lane: ThreadPoolExecutor(max_workers=n, thread_name_prefix=f"healthos-job-{lane}") for lane, n in workers.items()}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.jobs = {}
+
+    def submit(self, chunks_fn, *args, lane=INTERACTIVE):
+        """Start draining chunks_fn(*args); returns the job id."""
+        with self.lock:
+            self._prune()
+            job_id = next(self.ids)
+            self.jobs[job_id] = {"text": "", "done": False, "finished": None}
+        self.pools[lane].submit(_with_script_ctx(self._run, get_script_run_ctx()), job_id, chunks_fn, args)
+        return job_id
+
+    def _prune(self):
+        """Forget jobs finished more than JOB_KEEP_SECONDS ago; call with the lock held."""
+        now = time.time()
+        for old in [j for j, job in self.jobs.items() if job['done'] and now - job['finished'] > JOB_KEEP_SECONDS]: del self.jobs[old]
+
+    def _run(self, job_id, chunks_fn, args):
+        job = self.jobs[job_id]
+        try:
+            for chunk in chunks_fn(*args): job['text'] += chunk
+        except Exception as e: job['text'] += f"Error: {e}"
+        job['finished'], job['done'] = time.time(), True
+
+    def get(self, job_id):
+        """{'text', 'done', 'finished'}, or None for an unknown id (pruned, or from before a restart)."""
+        with self.lock:
+            self._prune()
+            return self.jobs.get(job_id)
+
+    def follow(self, job_id):
+        """The job's text as it grows (feed to st.write_stream); ends with the job."""
+        sent = 0
+        while True:
+            job = self.jobs.get(job_id)
+            if job is None: return
+            done, text = job['done'], job['text']
+            if len(text) > sent:
+                yield text[sent:]
+                sent = len(text)
+            if done: return
+            time.sleep(0.1)
+
+@st.cache_resource
+def job_runner(): return JobRunner(JOB_WORKERS)
+
 # --- 8. MAIN APP ---
 st.title("HealthOS")
-master_df, results_df, user_profile, msg = load_data()
+master_df, results_index, user_profile, msg = load_data()
 
 # --- AUTH SAFETY STOP ---
 if master_df is None: 
@@ -506,6 +1808,15 @@ if master_df is None:
     st.info("Please check your Secrets configuration in Streamlit Cloud.")
     st.stop()
 
+# Saves return before they reach the sheet; confirm them on the next run and keep the sync line live
+if 'flash' in st.session_state: st.toast(st.session_state.pop('flash'))
+
+@st.fragment(run_every=3 if write_queue() or get_storage().name == "mirror" else None)
+def sync_status():
+    line = sync_status_line()
+    if line: st.caption(line)
+sync_status()
+
 # --- NAVIGATION ---
 # Renamed "Lab Snapshot" -> "My Labs" to prevent wrapping on small phones
 page = st.radio("Go to", ["👤 Profile", "My Labs", "Trends"], horizontal=True, label_visibility="collapsed")
@@ -557,25 +1868,36 @@ if page == "👤 Profile":
                 "training_type": training_type, "train_freq": train_freq,
                 "goals": str(goals), "supplements": supplements, "bio_context": bio_context
             })
-            st.success("Saved!"); time.sleep(1); st.rerun()
+            st.session_state['flash'] = "Profile saved"; st.rerun()
             
     with st.expander("🗑️ Admin Zone"):
         if st.button("⚠️ Wipe Database"): clear_database(); st.warning("Cleared."); time.sleep(1); st.rerun()
+        sheets = getattr(get_storage(), 'remote', get_storage())
+        if sheets.name == "sheets":
+            st.caption(quota_status_line())
+            try: legacy = not sheets.results_sharded()
+            except: legacy = False  # offline
+            if legacy and st.button("🗂️ Split Results by year"):
+                with st.spinner("Splitting..."): sheets.split_results_by_year()
+                invalidate_datasets("results"); st.success("Done."); time.sleep(1); st.rerun()
+        if get_storage().name == "sqlite" and st.button("⬇️ Import from Google Sheets"):
+            with st.spinner("Copying..."): copy_storage(SheetsBackend(), get_storage())
+            invalidate_datasets(*DATASETS); st.success("Imported."); time.sleep(1); st.rerun()
 
 # PAGE 2
 elif page == "My Labs":
     with st.expander("📤 Upload New Lab"):
-        uploaded_lab = st.file_uploader("Drag & Drop Lab Image", type=['png', 'jpg', 'jpeg', 'pdf'])
+        uploaded_lab = st.file_uploader("Drag & Drop Lab Image", type=['png', 'jpg', 'jpeg', 'pdf', 'csv'])
         if uploaded_lab and st.button("Process & Digitize"):
             with st.spinner("AI Reading..."):
-                new_df, status = process_uploaded_image(uploaded_lab)
+                new_df, status = process_uploaded_image(uploaded_lab, master_df)
                 if new_df is not None:
                     smart_save_to_sheet(new_df)
-                    st.success(f"✅ Saved markers!"); time.sleep(1.5); st.rerun()
+                    st.session_state['flash'] = "✅ Saved markers!"; st.rerun()
                 else: st.error(status)
     
-    unique_dates = sorted(results_df['Date'].dropna().unique(), reverse=True)
-    date_options = [d.strftime('%Y-%m-%d') for d in unique_dates if pd.notna(d)]
+    unique_dates = sorted(results_index['When'].dropna().unique(), reverse=True)
+    date_options = [pd.Timestamp(d).strftime('%Y-%m-%d') for d in unique_dates]
     
     if not date_options:
         st.info("Database empty. Upload a lab above!")
@@ -588,7 +1910,10 @@ elif page == "My Labs":
     
     selected_label = st.selectbox("Select Lab Report:", date_options, index=default_idx)
 
-    snapshot = results_df[results_df['Date'].astype(str).str.startswith(selected_label)].copy()
+    # Only the partition(s) holding this report are read
+    shown = [d for d in unique_dates if pd.Timestamp(d).strftime('%Y-%m-%d') == selected_label]
+    snapshot = load_results_window(results_index, shown)
+    snapshot = snapshot[snapshot['Date'].astype(str).str.startswith(selected_label)].copy()
     processed_rows, stats = [], {"Blue": 0, "Green": 0, "Orange": 0, "Red": 0, "Mismatch": 0}
     
     for _, row in snapshot.iterrows():
@@ -603,7 +1928,12 @@ elif page == "My Labs":
             elif "BORDERLINE" in status: stats["Orange"] += 1
             elif "OUT OF RANGE" in status: stats["Red"] += 1
             
-            processed_rows.append({"Marker": master['Biomarker'], "Value": row['Value'], "Status": status, "Color": color, "Class": css, "Range": rng, "Meaning": master['Plain-English Meaning'], "Priority": prio, "Source": row['Source'], "Direction": direction})
+            # Status and range are in master units, so the value shown beside them is too (raw when it does not parse)
+            if pd.notna(row.get('NumericValue')):
+                bound = str(row['Value']).strip()[:1] if str(row['Value']).strip()[:1] in "<>" else ""
+                shown, unit = f"{bound}{row['NumericValue']:g}", row['CanonicalUnit']
+            else: shown, unit = row['Value'], row['Unit'] if pd.notna(row['Unit']) else ""
+            processed_rows.append({"Marker": master['Biomarker'], "Value": shown, "Unit": unit, "Status": status, "Color": color, "Class": css, "Range": rng, "Meaning": master['Plain-English Meaning'], "Priority": prio, "Source": row['Source'], "Direction": direction})
     
     df_view = filter_best_matches(processed_rows)
     df_display = df_view[~df_view['Status'].isin(['PERCENTAGE', 'UNIT MISMATCH'])]
@@ -619,11 +1949,31 @@ elif page == "My Labs":
     st.markdown(grid_html + "</div>", unsafe_allow_html=True)
 
     if st.button("🧠 Analyze Lab & History"):
-        with st.spinner("Analyzing..."):
-            st.session_state.ai_report = generate_snapshot_report(df_view, selected_label, user_profile, results_df)
-    if st.session_state.get('ai_report'):
-        with st.expander("🧠 HealthOS Intelligence Report", expanded=True):
-            st.markdown(f"""<div class="ai-report-box">{st.session_state.ai_report}</div>""", unsafe_allow_html=True)
+        st.session_state.report_job = job_runner().submit(generate_snapshot_report, df_view, selected_label, user_profile, load_results_window(results_index), results_version())
+        st.session_state.pop('ai_report', None)
+
+    @st.fragment(run_every=JOB_POLL_SECONDS if 'report_job' in st.session_state else None)
+    def report_panel():
+        if 'report_job' in st.session_state:
+            job = job_runner().get(st.session_state.report_job)
+            if job is None or job['done']:
+                if job is not None: st.session_state.ai_report = job['text']
+                del st.session_state['report_job']
+                st.rerun()  # full rerun to stop polling
+            with st.expander("🧠 HealthOS Intelligence Report", expanded=True):
+                st.markdown(job['text'] or "Analyzing...")
+        elif st.session_state.get('ai_report'):
+            with st.expander("🧠 HealthOS Intelligence Report", expanded=True):
+                st.markdown(f"""<div class="ai-report-box">{st.session_state.ai_report}</div>""", unsafe_allow_html=True)
+    report_panel()
+
+    # Explanations for the flagged markers are fetched in the background as soon as the lab is shown.
+    # Keys carry the lab date: row positions and marker names repeat from one lab to the next.
+    warn_key = lambda idx, r: f"b_warn_{selected_label}_{idx}_{r['Marker']}"
+    for idx, r in df_display[df_display['Priority'].isin([1, 2])].iterrows():
+        k = warn_key(idx, r)
+        if f"e_{k}" not in st.session_state and f"j_{k}" not in st.session_state:
+            st.session_state[f"j_{k}"] = job_runner().submit(generate_deep_dive, r['Marker'], r['Value'], r['Status'], user_profile, r['Unit'], lane=BACKGROUND)
 
     st.divider()
     c_warn, c_good = st.columns(2)
@@ -640,18 +1990,20 @@ elif page == "My Labs":
                         <div class="marker-sub" style="color:{r['Color']}">{r['Status']}</div>
                     </div>
                     <div style="text-align:right">
-                        <div class="marker-value" style="color:{r['Color']}">{r['Value']}</div>
+                        <div class="marker-value" style="color:{r['Color']}">{r['Value']} <span style="font-size:12px">{r['Unit']}</span></div>
                     </div>
                 </div>
             </div>""", unsafe_allow_html=True)
             
-            k = f"b_warn_{idx}_{r['Marker']}"
+            k = warn_key(idx, r)
             if st.button(f"Details: {r['Marker']}", key=k): st.session_state[f"d_{k}"] = True
             if st.session_state.get(f"d_{k}"):
-                if f"e_{k}" not in st.session_state:
-                    with st.spinner("..."): st.session_state[f"e_{k}"] = generate_deep_dive(r['Marker'], r['Value'], r['Status'], user_profile)
                 with st.expander("Explanation", expanded=True):
-                    st.write(st.session_state[f"e_{k}"])
+                    if f"e_{k}" not in st.session_state:
+                        job_id = st.session_state.get(f"j_{k}")
+                        chunks = job_runner().follow(job_id) if job_runner().get(job_id) else generate_deep_dive(r['Marker'], r['Value'], r['Status'], user_profile, r['Unit'])
+                        st.session_state[f"e_{k}"] = st.write_stream(chunks)
+                    else: st.write(st.session_state[f"e_{k}"])
                     if st.button("Close", key=f"c_{k}"): st.session_state[f"d_{k}"] = False; st.rerun()
 
     with c_good:
@@ -665,14 +2017,14 @@ elif page == "My Labs":
                         <div class="marker-title">{r['Marker']}</div>
                     </div>
                     <div style="text-align:right">
-                        <div class="marker-value" style="color:{r['Color']}">{r['Value']}</div>
+                        <div class="marker-value" style="color:{r['Color']}">{r['Value']} <span style="font-size:12px">{r['Unit']}</span></div>
                     </div>
                 </div>
             </div>""", unsafe_allow_html=True)
 
 # PAGE 3 - TREND HEATMAP
 elif page == "Trends":
-    if results_df.empty: st.info("Database empty."); st.stop()
+    if results_index.empty: st.info("Database empty."); st.stop()
     st.markdown("### 📈 Health Heatmap")
     
     # LEGEND
@@ -685,9 +2037,10 @@ elif page == "Trends":
     </div>
     """, unsafe_allow_html=True)
     
-    # FILTER: LATEST 3 DATES ONLY
-    all_dates = sorted(results_df['Date'].dropna().unique(), reverse=False)
+    # FILTER: LATEST 3 DATES ONLY (and only the partitions holding them are read)
+    all_dates = sorted(results_index['When'].dropna().unique(), reverse=False)
     unique_dates = all_dates[-3:]
+    results_df = load_results_window(results_index, unique_dates)
     
     results_df['UnifiedMarker'] = results_df['Marker'].apply(lambda x: unify_marker_names(x))
     results_df['Category'] = results_df['UnifiedMarker'].apply(lambda x: get_category(x))
@@ -704,7 +2057,10 @@ elif page == "Trends":
         st.markdown(f"<div class='ios-card'>", unsafe_allow_html=True)
         
         cat_df = results_df[results_df['Category'] == cat]
-        pivot = cat_df.pivot_table(index='UnifiedMarker', columns='Date', values='Value', aggfunc='first')
+        # Censored ("<0.5", ">90") or unparseable results are shown as written
+        as_written = cat_df['NumericValue'].isna() | cat_df['Value'].astype(str).str.strip().str[:1].isin(['<', '>'])
+        cat_df = cat_df.assign(TrendValue=cat_df['NumericValue'].astype(object).where(~as_written, cat_df['Value']))
+        pivot = cat_df.pivot_table(index='UnifiedMarker', columns='Date', values='TrendValue', aggfunc='first')
         
         for marker in pivot.index:
             col_html = ""
@@ -728,7 +2084,7 @@ elif page == "Trends":
                                 if num_val > prev_val: arrow = "<span class='arrow-bad'>↑</span>"
                                 elif num_val < prev_val: arrow = "<span class='arrow-good'>↓</span>"
                         
-                        display_val = f"{val}{arrow}"
+                        display_val = f"{num_val:g}{arrow}"
                         
                         master = fuzzy_match(marker, master_df)
                         if master is not None:
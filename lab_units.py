@@ -0,0 +1,239 @@
+"""
+Lab units and upload layouts shared by dashboard.py and clinical.py: one conversion table, one way of
+reading a result value and one registry of CSV layouts, so the same file reads and converts identically
+in both apps. ASCII-only like clinical.py: micro signs are escaped.
+"""
+import re
+
+import pandas as pd
+
+# (biomarker, from_unit, to_unit) -> (factor, offset); canonical = raw * factor + offset.
+# Biomarkers are master "Biomarker" names; the target unit is always the master's unit for that row.
+UNIT_CONVERSIONS = {
+    ("Total Testosterone", "nmol/L", "ng/dL"): (28.84, 0.0),
+    ("Total Testosterone", "ng/dL", "nmol/L"): (0.03467, 0.0),
+    ("Free Testosterone", "pmol/L", "pg/mL"): (0.2884, 0.0),
+    ("Free Testosterone", "nmol/L", "pg/mL"): (288.4, 0.0),
+    ("Free Testosterone", "pg/mL", "pmol/L"): (3.467, 0.0),
+    ("Free Testosterone", "nmol/L", "pmol/L"): (1000.0, 0.0),
+    ("Free Testosterone", "pmol/L", "nmol/L"): (0.001, 0.0),
+    ("Oestradiol", "pmol/L", "pg/mL"): (0.2724, 0.0),
+    ("Oestradiol", "pg/mL", "pmol/L"): (3.671, 0.0),
+    ("DHT", "nmol/L", "ng/dL"): (29.04, 0.0),
+    ("DHEA-S", "umol/L", "ug/dL"): (36.81, 0.0),
+    ("DHEA-S", "ug/dL", "umol/L"): (0.02714, 0.0),
+    ("Prolactin", "mIU/L", "ng/mL"): (0.0472, 0.0),
+    ("Prolactin", "ng/mL", "mIU/L"): (21.2, 0.0),
+    ("Progesterone (Male)", "nmol/L", "ng/mL"): (0.3145, 0.0),
+    ("Free T4", "pmol/L", "ng/dL"): (0.0777, 0.0),
+    ("Free T4", "ng/dL", "pmol/L"): (12.87, 0.0),
+    ("Free T3", "pmol/L", "pg/mL"): (0.651, 0.0),
+    ("Free T3", "pg/mL", "pmol/L"): (1.536, 0.0),
+    ("Total Cholesterol", "mmol/L", "mg/dL"): (38.67, 0.0),
+    ("Total Cholesterol", "mg/dL", "mmol/L"): (0.02586, 0.0),
+    ("LDL Cholesterol", "mmol/L", "mg/dL"): (38.67, 0.0),
+    ("LDL Cholesterol", "mg/dL", "mmol/L"): (0.02586, 0.0),
+    ("HDL Cholesterol", "mmol/L", "mg/dL"): (38.67, 0.0),
+    ("HDL Cholesterol", "mg/dL", "mmol/L"): (0.02586, 0.0),
+    ("Non-HDL Cholesterol", "mmol/L", "mg/dL"): (38.67, 0.0),
+    ("Non-HDL Cholesterol", "mg/dL", "mmol/L"): (0.02586, 0.0),
+    ("Triglycerides", "mmol/L", "mg/dL"): (88.57, 0.0),
+    ("Triglycerides", "mg/dL", "mmol/L"): (0.01129, 0.0),
+    ("ApoB", "g/L", "mg/dL"): (100.0, 0.0),
+    ("ApoB", "mg/dL", "g/L"): (0.01, 0.0),
+    ("HbA1c", "mmol/mol", "%"): (0.0915, 2.15),
+    ("HbA1c", "%", "mmol/mol"): (10.929, -23.50),
+    ("Glucose", "mmol/L", "mg/dL"): (18.016, 0.0),
+    ("Glucose", "mg/dL", "mmol/L"): (0.0555, 0.0),
+    ("Fasting Glucose", "mmol/L", "mg/dL"): (18.016, 0.0),
+    ("Fasting Glucose", "mg/dL", "mmol/L"): (0.0555, 0.0),
+    ("Insulin", "pmol/L", "uIU/mL"): (0.144, 0.0),
+    ("Insulin", "uIU/mL", "pmol/L"): (6.945, 0.0),
+    ("Fasting Insulin", "pmol/L", "uIU/mL"): (0.144, 0.0),
+    ("Fasting Insulin", "uIU/mL", "pmol/L"): (6.945, 0.0),
+    ("Creatinine", "umol/L", "mg/dL"): (0.01131, 0.0),
+    ("Creatinine", "mg/dL", "umol/L"): (88.4, 0.0),
+    ("Urea", "mmol/L", "mg/dL"): (2.801, 0.0),
+    ("Urea", "mg/dL", "mmol/L"): (0.357, 0.0),
+    ("BUN", "mmol/L", "mg/dL"): (2.801, 0.0),
+    ("BUN", "mg/dL", "mmol/L"): (0.357, 0.0),
+    ("Uric Acid", "umol/L", "mg/dL"): (0.01681, 0.0),
+    ("Uric Acid", "mmol/L", "mg/dL"): (16.81, 0.0),
+    ("Uric Acid", "mg/dL", "umol/L"): (59.48, 0.0),
+    ("Haemoglobin", "g/L", "g/dL"): (0.1, 0.0),
+    ("Haemoglobin", "mmol/L", "g/dL"): (1.611, 0.0),
+    ("Haemoglobin", "g/dL", "g/L"): (10.0, 0.0),
+    ("Haematocrit", "L/L", "%"): (100.0, 0.0),
+    ("Haematocrit", "%", "L/L"): (0.01, 0.0),
+    ("CRP", "mg/dL", "mg/L"): (10.0, 0.0),
+    ("hs-CRP", "mg/dL", "mg/L"): (10.0, 0.0),
+    ("hs-CRP", "mg/L", "mg/dL"): (0.1, 0.0),
+    ("Iron", "umol/L", "ug/dL"): (5.585, 0.0),
+    ("Iron", "ug/dL", "umol/L"): (0.1791, 0.0),
+    ("TIBC", "umol/L", "ug/dL"): (5.585, 0.0),
+    ("Magnesium", "mmol/L", "mg/dL"): (2.431, 0.0),
+    ("Magnesium", "mg/dL", "mmol/L"): (0.4114, 0.0),
+    ("Calcium", "mmol/L", "mg/dL"): (4.008, 0.0),
+    ("Calcium", "mg/dL", "mmol/L"): (0.2495, 0.0),
+    ("Zinc", "umol/L", "ug/dL"): (6.54, 0.0),
+    ("Vitamin D", "nmol/L", "ng/mL"): (0.4006, 0.0),
+    ("Vitamin D", "ng/mL", "nmol/L"): (2.496, 0.0),
+    ("Vitamin B12", "pmol/L", "pg/mL"): (1.355, 0.0),
+    ("Vitamin B12", "pg/mL", "pmol/L"): (0.738, 0.0),
+    ("Folate", "nmol/L", "ng/mL"): (0.4413, 0.0),
+    ("Folate", "ng/mL", "nmol/L"): (2.266, 0.0),
+}
+
+# Values above the threshold with no unit (or the canonical unit) are implausible there and
+# are read in the given unit instead (e.g. IFCC HbA1c reported as "38" or "38 %").
+UNIT_INFERENCE = {
+    "HbA1c": (20.0, "mmol/mol"),
+}
+
+# Spellings that are numerically identical are folded onto one token before lookup.
+UNIT_ALIASES = {
+    "ug/l": "ng/ml",
+    "ng/l": "pg/ml",
+    "uiu/ml": "miu/l",
+    "iu/l": "miu/ml",
+    "u/l": "miu/ml",
+    "k/ul": "10^9/l",
+    "x10e9/l": "10^9/l",
+    "x10^9/l": "10^9/l",
+    "m/ul": "10^12/l",
+    "x10e12/l": "10^12/l",
+    "x10^12/l": "10^12/l",
+}
+
+
+def biomarker_key(name):
+    if pd.isna(name):
+        return ""
+    return re.sub(r"\s+", " ", str(name).strip().upper())
+
+
+def normalize_unit(unit):
+    if pd.isna(unit):
+        return ""
+    u = str(unit).strip().replace("\u00b5", "u").replace("\u03bc", "u").replace(" ", "").lower()
+    return UNIT_ALIASES.get(u, u)
+
+
+def parse_value(val):
+    """The number in a result cell ("5.4", "1,200", "<0.5", "38 mmol/mol"), or None."""
+    if pd.isna(val) or str(val).strip() == "":
+        return None
+    s = str(val).strip().replace(",", "").replace(" ", "")
+    s = s.replace("\u00b5", "u")
+    s = s.replace("ug/L", "").replace("ug/dL", "").replace("ng/mL", "").replace("mg/dL", "")
+    s = s.replace("mIU/L", "").replace("uIU/mL", "").replace("nmol/L", "").replace("%", "")
+    s = s.replace("<", "").replace(">", "")
+    match = re.search(r"[-+]?\d*\.\d+|\d+", s)
+    if match:
+        try:
+            return float(match.group())
+        except Exception:
+            return None
+    return None
+
+
+def extract_unit(val):
+    """The unit trailing a value cell ("38 mmol/mol" -> "mmol/mol"), or ""."""
+    if pd.isna(val):
+        return ""
+    match = re.search(r"\d\s*([A-Za-z%\u00b5\u03bc][A-Za-z0-9%/^.\u00b5\u03bc]*)\s*$", str(val).strip())
+    return match.group(1) if match else ""
+
+
+CONVERSION_TABLE = pd.DataFrame(
+    [(biomarker_key(b), normalize_unit(f), normalize_unit(t), factor, offset) for (b, f, t), (factor, offset) in UNIT_CONVERSIONS.items()],
+    columns=["Biomarker", "From", "To", "Factor", "Offset"],
+)
+
+
+def canonicalize(values, units, biomarkers, targets):
+    """
+    Column-wise conversion into master units. `values`/`units` are the raw Value and Unit columns (a blank
+    Unit is read off the value cell); `biomarkers`/`targets` are the matched master Biomarker and Unit per
+    row, "" where nothing matched. Returns (numeric value, unit it is expressed in). Values with no unit, an
+    already-canonical unit, or no table entry keep their number.
+    """
+    raw = pd.to_numeric(values.map(parse_value), errors="coerce")
+    unit = units.fillna("").astype(str).str.strip()
+    unit = unit.where(unit != "", values.map(extract_unit))
+    biomarker = biomarkers.fillna("").map(biomarker_key)
+    target = targets.fillna("").astype(str)
+
+    unit_norm = unit.map({u: normalize_unit(u) for u in unit.unique()})
+    target_norm = target.map({u: normalize_unit(u) for u in target.unique()})
+    for b, (threshold, inferred) in UNIT_INFERENCE.items():
+        unlabeled = (unit_norm == "") | (unit_norm == target_norm)
+        mask = (biomarker == biomarker_key(b)) & unlabeled & (raw > threshold)
+        unit = unit.mask(mask, inferred)
+        unit_norm = unit_norm.mask(mask, normalize_unit(inferred))
+
+    keys = pd.DataFrame({"Biomarker": biomarker, "From": unit_norm, "To": target_norm})
+    factors = keys.merge(CONVERSION_TABLE, how="left", on=["Biomarker", "From", "To"]).set_index(values.index)
+    converted = factors["Factor"].notna()
+    native = (unit_norm == "") | (unit_norm == target_norm)
+    value = raw.where(~converted, raw * factors["Factor"] + factors["Offset"])
+    return value, target.where(converted | (native & (target != "")), unit)
+
+
+# --- CSV upload layouts ---
+# Known CSV exports, recognised from the lower-cased header alone and mapped column for column. Each parser
+# takes the frame as read (original header case) and returns raw Date/Marker/Value/Unit/Flag strings; the
+# apps clean values and dates their own way. More specific layouts go first.
+DATE_HEADERS = {"date", "collected", "collection date", "date collected", "sample date", "report date"}
+HEADER_UNIT = re.compile(r"^(.*?)\s*[\(\[]([^\)\]]+)[\)\]]\s*$")  # "Glucose (mmol/L)"
+# Words that name a column of a one-row-per-result file, never a marker
+LONG_FORMAT_WORDS = re.compile(r"\b(marker|biomarker|test|tests|analyte|name|result|results|value|values|unit|units|reading|flag|range)\b")
+LAYOUT_COLUMNS = ["Date", "Marker", "Value", "Unit", "Flag"]
+
+
+def layout_columns(mapping):
+    """Parser for one row per result, given a lower-case header -> LAYOUT_COLUMNS mapping."""
+    def parse(df):
+        df = df.rename(columns=lambda c: mapping.get(str(c).strip().lower(), c))
+        df = df.loc[:, ~df.columns.duplicated()].copy()
+        for c in LAYOUT_COLUMNS:
+            if c not in df.columns:
+                df[c] = ""
+        return df[LAYOUT_COLUMNS]
+    return parse
+
+
+def wide_header(cols):
+    """Date first, then one column per marker ("HbA1c", "Glucose (mmol/L)"); a long-format column name rules it out."""
+    if len(cols) < 3 or cols[0] not in DATE_HEADERS or DATE_HEADERS & set(cols[1:]):
+        return False
+    names = [(HEADER_UNIT.match(c).group(1) if HEADER_UNIT.match(c) else c) for c in cols[1:]]
+    return not any(LONG_FORMAT_WORDS.search(n) for n in names)
+
+
+def layout_wide(df):
+    df = df.rename(columns=lambda c: str(c).strip())
+    long = df.melt(id_vars=[df.columns[0]], var_name="Header", value_name="Value")
+    long = long.rename(columns={df.columns[0]: "Date"})
+    parts = long["Header"].astype(str).str.extract(HEADER_UNIT)
+    long["Marker"] = parts[0].fillna(long["Header"]).str.strip()
+    long["Unit"], long["Flag"] = parts[1].fillna(""), ""
+    long = long[long["Value"].notna() & (long["Value"].astype(str).str.strip() != "")]
+    return long[LAYOUT_COLUMNS]
+
+
+CSV_LAYOUTS = [
+    {"name": "HealthOS export",
+     "match": lambda cols: {"marker", "value", "date"} <= set(cols),
+     "parse": layout_columns({"marker": "Marker", "value": "Value", "unit": "Unit", "flag": "Flag", "date": "Date"})},
+    {"name": "LIS result export",
+     "match": lambda cols: {"test name", "result"} <= set(cols) and bool(DATE_HEADERS & set(cols)),
+     "parse": layout_columns({"test name": "Marker", "result": "Value", "units": "Unit", "unit": "Unit", "result units": "Unit",
+                              "flag": "Flag", "abnormal flag": "Flag", **{h: "Date" for h in DATE_HEADERS}})},
+    {"name": "wide table", "match": wide_header, "parse": layout_wide},
+]
+
+
+def match_csv_layout(cols):
+    """The first CSV_LAYOUTS entry whose fingerprint holds for the lower-cased header, or None."""
+    return next((layout for layout in CSV_LAYOUTS if layout["match"](cols)), None)
@@ -0,0 +1,38 @@
+"""
+The apps are single Streamlit scripts, so tests load everything above their page-rendering section into a
+namespace (functions, constants, classes) without drawing a page. Local stores point at a temp directory.
+"""
+import logging
+import os
+import sys
+
+import pytest
+import streamlit as st
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+
+def load_app(filename, stop_marker):
+    path = os.path.join(ROOT, filename)
+    with open(path, encoding="utf-8") as f:
+        src = f.read()
+    ns = {"__name__": "healthos_test", "__file__": path}
+    exec(compile(src[:src.index(stop_marker)], path, "exec"), ns)
+    return ns
+
+
+@pytest.fixture(scope="session")
+def dash(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("dashboard")
+    for env, name in (("HEALTHOS_CACHE_PATH", "cache.db"), ("HEALTHOS_SQLITE_PATH", "healthos.db"),
+                      ("HEALTHOS_MIRROR_PATH", "mirror.db"), ("HEALTHOS_QUEUE_PATH", "queue.db")):
+        os.environ[env] = str(tmp / name)
+    st.secrets = {"GOOGLE_API_KEY": "test"}  # never used: no test calls the model
+    return load_app("dashboard.py", "# --- 8. MAIN APP ---")
+
+
+@pytest.fixture(scope="session")
+def clinical():
+    return load_app("clinical.py", "# 9) APP STATE + TOPBAR")
@@ -0,0 +1,46 @@
+import pytest
+
+PROFILE = {"age": "41", "gender": "Male", "smoke": "No", "alcohol": "Social", "training_type": "Strength",
+           "supplements": "Creatine", "bio_context": "Desk job, sleeps badly.", "goals": "Longevity", "weight": "82"}
+
+
+@pytest.mark.parametrize("value, bucket", [
+    (5.43, "5.4"), ("5.38", "5.4"), (6.1, "6.1"), (235.9, "240"), (0.0123, "0.012"), ("<0.5", "<0.5"), (None, "None"),
+])
+def test_value_bucket(dash, value, bucket):
+    assert dash["value_bucket"](value) == bucket
+
+
+@pytest.fixture
+def model(dash, monkeypatch, tmp_path):
+    prompts = []
+
+    def stream(prompt, unavailable):
+        prompts.append(prompt)
+        yield f"explanation {len(prompts)}"
+    monkeypatch.setitem(dash, "stream_model_text", stream)
+    cache = dash["DiskCache"](str(tmp_path / "cache.db"), 1 << 20)
+    monkeypatch.setitem(dash, "disk_cache", lambda: cache)
+    return prompts
+
+
+def explain(dash, value, profile=PROFILE, unit="mmol/L"):
+    return "".join(dash["generate_deep_dive"]("LDL Cholesterol", value, "High", profile, unit))
+
+
+def test_prompt_quotes_the_bucket_it_is_cached_under(dash, model):
+    # 4.53 and 4.48 share an entry, so the text may only ever quote the shared 4.5
+    assert explain(dash, "4.53") == explain(dash, "4.48") == "explanation 1"
+    assert "Level: 4.5 mmol/L" in model[0] and "4.53" not in model[0]
+    assert explain(dash, "5.1") == "explanation 2"
+    assert "Level: 5.1 mmol/L" in model[1]
+
+
+def test_cache_key_covers_the_profile_text_sent(dash, model):
+    first = explain(dash, "4.5")
+    assert "Desk job, sleeps badly." in model[0] and "Longevity" in model[0]
+    assert explain(dash, "4.5", dict(PROFILE)) == first
+    # Anything that changes the prompt's profile section is a different entry
+    for change in [{"bio_context": "New job."}, {"goals": "Strength"}, {"weight": "90"}, {"gender": "Female"}]:
+        explain(dash, "4.5", {**PROFILE, **change})
+    assert len(model) == 5
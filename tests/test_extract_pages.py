@@ -0,0 +1,64 @@
+import types
+
+import pandas as pd
+import pytest
+
+PAGES = {}  # page bytes -> outcomes still to return
+
+
+def page(*rows):
+    return pd.DataFrame(rows, columns=["Marker", "Value", "Unit", "Date"])
+
+
+@pytest.fixture
+def run(dash, monkeypatch):
+    """extract_pages over fake pages: each page is a list of outcomes, one per attempt (frame, status or exception)."""
+    sent, sleeps = [], []
+    monkeypatch.setitem(dash, "time", types.SimpleNamespace(sleep=sleeps.append))
+
+    def extract_part(data, mime_type):
+        sent.append(data)
+        outcome = PAGES[data].pop(0)
+        if isinstance(outcome, Exception): raise outcome
+        return outcome if isinstance(outcome, tuple) else (outcome, "Success")
+    monkeypatch.setitem(dash, "extract_part", extract_part)
+
+    def go(pages):
+        PAGES.clear()
+        PAGES.update({name: list(outcomes) for name, outcomes in pages.items()})
+        df, status = dash["extract_pages"](list(pages), "application/pdf")
+        return df, status, sent, sleeps
+    return go
+
+
+def test_pages_are_merged_in_order_and_dated(run):
+    df, status, _, _ = run({
+        "p1": [page(["LDL", "3.1", "mmol/L", "2024-03-01"], ["HDL", "1.2", "mmol/L", "2024-03-01"])],
+        "p2": [page(["TSH", "2.0", "mU/L", None], ["HDL", "1.3", "mmol/L", ""])],  # continuation page: no date
+        "p3": [page(["Ferritin", "80", "ug/L", "2024-03-01"], ["B12", "400", "ng/L", "2024-02-28"])],
+    })
+    assert status == "Success"
+    # The date most pages agree on fills the gaps; the repeated HDL keeps its first reading
+    assert df[["Marker", "Value", "Date"]].values.tolist() == [
+        ["LDL", "3.1", "2024-03-01"], ["HDL", "1.2", "2024-03-01"], ["TSH", "2.0", "2024-03-01"],
+        ["Ferritin", "80", "2024-03-01"], ["B12", "400", "2024-02-28"]]
+
+
+def test_only_failed_pages_are_resent_with_backoff(dash, run):
+    ok = page(["LDL", "3.1", "mmol/L", "2024-03-01"])
+    df, status, sent, sleeps = run({
+        "p1": [ok],
+        "p2": [RuntimeError("429"), RuntimeError("429"), page(["HDL", "1.2", "mmol/L", "2024-03-01"])],
+        "p3": [RuntimeError("429"), ok.assign(Marker="TSH")],
+    })
+    assert status == "Success" and df["Marker"].tolist() == ["LDL", "HDL", "TSH"]
+    assert sorted(sent) == ["p1", "p2", "p2", "p2", "p3", "p3"]
+    base = dash["EXTRACT_RETRY_BACKOFF"]
+    assert sleeps == [base, 2 * base]
+
+
+def test_unreadable_pages_are_skipped_but_errors_fail(run):
+    df, status, sent, _ = run({"p1": [page(["LDL", "3.1", "mmol/L", "2024-03-01"])], "p2": [(None, "Structure failed.")]})
+    assert status == "Success (skipped unreadable page 2)" and sent.count("p2") == 1
+    df, status, _, _ = run({"p1": [page(["LDL", "3.1", "mmol/L", "2024-03-01"])], "p2": [RuntimeError("quota")] * 3})
+    assert df is None and status == "Page 2 of 2 failed: quota"
@@ -0,0 +1,65 @@
+import random
+
+import pandas as pd
+import pytest
+from difflib import SequenceMatcher
+
+
+def scan_match(dash, marker, master):
+    """The row-by-row scan FuzzyMatcher compiles."""
+    smart_clean = dash["smart_clean"]
+    lab_clean = smart_clean(marker)
+    best_row, best_score = None, 0.0
+    for _, row in master.iterrows():
+        for key in [smart_clean(k) for k in str(row['Fuzzy Match Keywords']).split(",")]:
+            if ("NON" in lab_clean) != ("NON" in key): continue
+            if key == lab_clean: return row
+            if lab_clean.startswith(key) and len(key) > 2: return row
+            score = SequenceMatcher(None, lab_clean, key).ratio()
+            if score > best_score: best_score, best_row = score, row
+    return best_row if best_score > 0.60 else None
+
+
+WORDS = ["HDL", "LDL", "NON-HDL", "CHOLESTEROL", "TRIG", "GLUCOSE", "INSULIN", "IRON", "FERRITIN", "TSH", "T4", "FREE T4",
+         "TESTOSTERONE", "FREE TESTOSTERONE", "VITAMIN D", "B12", "CRP", "HS-CRP", "ALT", "AST", "UREA"]
+
+
+def random_master(rng, rows=12):
+    return pd.DataFrame({"Biomarker": [f"B{i}" for i in range(rows)],
+                         "Fuzzy Match Keywords": [",".join(rng.sample(WORDS, rng.randint(1, 3))) for _ in range(rows)]})
+
+
+def random_name(rng):
+    name = rng.choice(WORDS)
+    return rng.choice(["", "Serum ", "S- ", "Total "]) + rng.choice([name, name.lower(), name + " (calc)", name[:-1], name + "X"])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_same_row_as_the_scan(dash, seed):
+    rng = random.Random(seed)
+    master = random_master(rng)
+    matcher = dash["FuzzyMatcher"](master)
+    for name in [random_name(rng) for _ in range(40)]:
+        expected, got = scan_match(dash, name, master), matcher.match(name)
+        assert (None if expected is None else expected['Biomarker']) == (None if got is None else got['Biomarker']), name
+
+
+def test_unnormalized_master_is_checksummed_once(dash, monkeypatch):
+    calls = []
+    checksum = dash["master_checksum"]
+    monkeypatch.setitem(dash, "master_checksum", lambda m: calls.append(1) or checksum(m))
+    master = pd.DataFrame({"Biomarker": ["LDL Cholesterol"], "Fuzzy Match Keywords": ["LDL"]})
+    assert all(dash["fuzzy_match"](name, master)['Biomarker'] == "LDL Cholesterol" for name in ["LDL", "Serum LDL", "LDL-C"])
+    assert len(calls) == 1
+
+
+def test_derived_frames_do_not_reuse_the_full_masters_matcher(dash):
+    master = dash["normalize_master"](pd.DataFrame({"Biomarker": ["Ferritin", "HDL Cholesterol"],
+                                                    "Fuzzy Match Keywords": ["Ferritin", "HDL"], "Unit": ["ug/L", "mmol/L"]}))
+    assert dash["fuzzy_match"]("HDL", master)['Biomarker'] == "HDL Cholesterol"
+    ferritin_only = master[master['Biomarker'] == "Ferritin"]
+    assert ferritin_only.attrs['checksum'] == master.attrs['checksum']  # pandas carries attrs over
+    assert dash["fuzzy_match"]("HDL", ferritin_only) is None
+    edited = master.copy()
+    edited.loc[1, ['Biomarker', 'Fuzzy Match Keywords']] = ["Vitamin B12", "B12"]
+    assert dash["fuzzy_match"]("HDL", edited) is None and dash["fuzzy_match"]("B12", edited)['Biomarker'] == "Vitamin B12"
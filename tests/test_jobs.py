@@ -0,0 +1,34 @@
+import time
+
+
+def wait(runner, job_id):
+    for _ in range(100):
+        job = runner.jobs.get(job_id)
+        if job is None or job['done']: return job
+        time.sleep(0.01)
+
+
+def test_follow_streams_the_whole_text(dash):
+    runner = dash["JobRunner"]({dash["INTERACTIVE"]: 1})
+    job_id = runner.submit(lambda n: (f"{i} " for i in range(n)), 3)
+    assert "".join(runner.follow(job_id)) == "0 1 2 "
+    assert runner.get(job_id)['done']
+
+
+def test_errors_end_the_job(dash):
+    def broken():
+        yield "partial "
+        raise RuntimeError("quota")
+    runner = dash["JobRunner"]({dash["INTERACTIVE"]: 1})
+    job_id = runner.submit(broken)
+    assert wait(runner, job_id)['text'] == "partial Error: quota"
+
+
+def test_finished_jobs_are_pruned_on_get(dash, monkeypatch):
+    runner = dash["JobRunner"]({dash["INTERACTIVE"]: 1})
+    done = runner.submit(lambda: iter(["x"]))
+    wait(runner, done)
+    monkeypatch.setitem(dash, "JOB_KEEP_SECONDS", 0)
+    time.sleep(0.01)
+    assert runner.get(done) is None
+    assert runner.jobs == {}
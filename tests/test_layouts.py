@@ -0,0 +1,57 @@
+import io
+
+import pandas as pd
+import pytest
+
+from lab_units import match_csv_layout, wide_header
+
+MASTER = pd.DataFrame({"Biomarker": ["LDL Cholesterol", "HbA1c"], "Fuzzy Match Keywords": ["LDL", "HbA1c"], "Unit": ["mmol/L", "%"]})
+
+FILES = {
+    "HealthOS export": ("Marker,Value,Unit,Flag,Date\nLDL,3.1,mmol/L,H,2024-03-01\nHbA1c,5.4,%,,2024-03-01\n",
+                        [("LDL", "3.1", "mmol/L", "2024-03-01"), ("HbA1c", "5.4", "%", "2024-03-01")]),
+    "LIS result export": ("Patient Name,Test Name,Result,Result Units,Collection Date\nDoe,LDL,3.1,mmol/L,01/03/2024\nDoe,HbA1c,5.4,%,01/03/2024\n",
+                          [("LDL", "3.1", "mmol/L", "2024-03-01"), ("HbA1c", "5.4", "%", "2024-03-01")]),
+    "wide table": ("Date,LDL (mmol/L),HbA1c\n2024-03-01,3.1,5.4\n2024-06-01,2.8,\n",
+                   [("LDL", "3.1", "mmol/L", "2024-03-01"), ("LDL", "2.8", "mmol/L", "2024-06-01"), ("HbA1c", "5.4", "", "2024-03-01")]),
+}
+LONG_WITH_DATE_FIRST = "Date,Test,Result,Units\n2024-03-01,LDL,3.1,mmol/L\n2024-03-01,HbA1c,5.4,%\n"
+
+
+def header(text): return [h.strip().lower() for h in text.splitlines()[0].split(",")]
+
+
+@pytest.mark.parametrize("name", FILES)
+def test_each_layout_is_recognised(name):
+    assert match_csv_layout(header(FILES[name][0]))["name"] == name
+
+
+@pytest.mark.parametrize("cols", [
+    "date,test,result,units", "collected,analyte,value", "date,marker name,reading", "date,ldl,reference range", "date,ldl",
+])
+def test_long_format_headers_are_not_wide(cols):
+    assert not wide_header(cols.split(","))
+
+
+@pytest.mark.parametrize("name", FILES)
+def test_dashboard_reads_each_layout(dash, name):
+    text, expected = FILES[name]
+    df, status = dash["template_extract"](text.encode(), "text/csv", MASTER)
+    assert status == f"Success ({name})"
+    rows = sorted(zip(df["Marker"], df["Value"], df["Unit"], df["Date"]))
+    assert rows == sorted(expected)
+
+
+@pytest.mark.parametrize("name", FILES)
+def test_clinical_reads_each_layout(clinical, name):
+    text, expected = FILES[name]
+    layout, df = clinical["match_upload_layout"](pd.read_csv(io.StringIO(text), sep=None, engine="python"))
+    assert layout == name
+    dates = [pd.to_datetime(d, dayfirst="/" in d).strftime("%Y-%m-%d") for d in df["Date"]]
+    rows = sorted(zip(df["Marker"], df["Value"].astype(str), df["Unit"].fillna("").astype(str), dates))
+    assert rows == sorted(expected)
+
+
+def test_long_file_with_date_first_is_left_to_the_heuristics(dash, clinical):
+    assert dash["template_extract"](LONG_WITH_DATE_FIRST.encode(), "text/csv", MASTER) is None  # the model reads it
+    assert clinical["match_upload_layout"](pd.read_csv(io.StringIO(LONG_WITH_DATE_FIRST))) is None
@@ -0,0 +1,45 @@
+import random
+
+import pandas as pd
+import pytest
+
+NAMES = ["LDL Cholesterol", "ApoB", "Apolipoprotein B", "Lipoprotein(a)", "Insulin", "Fasting Insulin", "HbA1c",
+         "SHBG", "LH", "Free T3", "Free T4", "Serum Iron", "hs-CRP", "CRP", "Ferritin", "Total Testosterone"]
+
+
+def history(seed, n=200):
+    rng = random.Random(seed)
+    dates = pd.to_datetime([f"2023-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}" for _ in range(n)])
+    return pd.DataFrame({"Marker": [rng.choice(NAMES) for _ in range(n)], "Value": [str(rng.randint(1, 99)) for _ in range(n)], "Date": dates})
+
+
+def scan_related(dash, hist):
+    """The straightforward per-target scan the index replaces."""
+    latest = {}
+    for _, r in hist.sort_values("Date", kind="stable").iterrows():
+        latest[dash["smart_clean"](r["Marker"])] = {"Marker": r["Marker"], "Value": r["Value"], "Date": r["Date"]}
+    out = {}
+    for target in {t for ts in dash["RELATED_MARKERS"].values() for t in ts}:
+        matches = [row for k, row in latest.items() if k == dash["smart_clean"](target) or target in k]
+        if matches: out[target] = max(matches, key=lambda row: row["Date"])
+    return out
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_related_matches_a_full_scan(dash, seed):
+    hist = history(seed)
+    assert dash["build_marker_index"](("test", seed), hist)["related"] == scan_related(dash, hist)
+
+
+def test_latest_row_per_marker(dash):
+    hist = pd.DataFrame({"Marker": ["LDL", "LDL", "HDL"], "Value": ["3.1", "2.9", "1.2"],
+                         "Date": pd.to_datetime(["2024-03-01", "2024-01-01", "2024-02-01"])})
+    latest = dash["build_marker_index"]("latest", hist)["latest"]
+    assert latest["LDL"] == {"Marker": "LDL", "Value": "3.1", "Date": pd.Timestamp("2024-03-01")}
+    assert set(latest) == {"LDL", "HDL"}
+
+
+def test_cached_on_the_version_not_the_frame(dash):
+    first = dash["build_marker_index"](("cache", 1), history(1))
+    assert dash["build_marker_index"](("cache", 1), history(2))["related"] == first["related"]
+    assert dash["build_marker_index"](("cache", 2), history(2))["related"] == scan_related(dash, history(2))
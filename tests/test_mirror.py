@@ -0,0 +1,126 @@
+import re
+
+import gspread
+import pandas as pd
+import pytest
+
+
+class FakeWorksheet:
+    def __init__(self, title, data): self.title, self.data = title, data
+    def get_all_values(self): return [list(r) for r in self.data]
+    def get(self, a1): return [list(r) for r in self.data[int(re.match(r"A(\d+)", a1).group(1)) - 1:]]
+
+
+@pytest.fixture
+def fast(dash, monkeypatch):
+    # Keep the background threads asleep; the tests drive pull() and flush() themselves
+    monkeypatch.setitem(dash, "MIRROR_PULL_SECONDS", 3600)
+    monkeypatch.setitem(dash, "WRITE_BATCH_SECONDS", 3600)
+    return dash
+
+
+def frame(dash, rows): return pd.DataFrame(rows, columns=dash["REQUIRED_COLUMNS"])
+
+
+def counting(store):
+    calls = []
+    read = store.read_results_raw
+    store.read_results_raw = lambda dates=None: calls.append(dates) or read(dates)
+    return calls
+
+
+def mirror(dash, remote, tmp_path):
+    return dash["MirroredBackend"](remote, dash["SQLiteBackend"](str(tmp_path / "mirror.db")), str(tmp_path / "queue.db"))
+
+
+def test_pull_copies_changes_and_skips_unchanged_dates(fast, tmp_path):
+    dash = fast
+    remote = dash["SQLiteBackend"](str(tmp_path / "remote.db"))
+    remote.save_results(frame(dash, [["A", "1", "", "", "2024-01-01", ""], ["B", "2", "", "", "2024-01-01", ""], ["A", "3", "", "", "2024-02-01", ""]]))
+    m = mirror(dash, remote, tmp_path)
+    assert len(m.read_results_raw()) == 3
+
+    calls = counting(remote)
+    m.pull()
+    assert calls == []  # row counts agree: nothing is re-read
+
+    remote.save_results(frame(dash, [["A", "9", "", "", "2024-02-01", ""], ["C", "1", "", "", "2024-02-01", ""]]))
+    remote.replace_dates(["2024-01-01"], frame(dash, []))
+    m.pull()
+    assert calls == [["2024-02-01"]]
+    assert sorted(m.read_results_raw()[["Marker", "Value", "Date"]].values.tolist()) == [["A", "9", "2024-02-01"], ["C", "1", "2024-02-01"]]
+
+
+def test_pull_never_overwrites_unpushed_dates(fast, tmp_path):
+    dash = fast
+    remote = dash["SQLiteBackend"](str(tmp_path / "remote.db"))
+    remote.save_results(frame(dash, [["A", "1", "", "", "2024-01-01", ""]]))
+    m = mirror(dash, remote, tmp_path)
+    m.save_results(frame(dash, [["A", "2", "", "", "2024-01-01", ""], ["B", "5", "", "", "2024-03-01", ""]]))
+    m.pull(full=True)
+    assert sorted(m.read_results_raw()["Value"]) == ["2", "5"]
+    m.queue.flush()
+    assert sorted(remote.read_results_raw()["Value"]) == ["2", "5"]
+
+
+def test_legacy_sheet_is_counted_in_raw_rows(fast, tmp_path, monkeypatch):
+    # Rows the app drops (blank value, unparseable date) and non-ISO dates must not make the sheet look changed
+    dash = fast
+    sheet = FakeWorksheet("Results", [dash["REQUIRED_COLUMNS"],
+                                      ["A", "1", "", "", "01/02/2024", ""], ["B", "", "", "", "01/02/2024", ""],
+                                      ["C", "3", "", "", "unknown", ""], ["D", "4", "", "", "2024-03-01", ""]])
+
+    def get_worksheet(title, create=None):
+        if title == "Results": return sheet
+        raise gspread.exceptions.WorksheetNotFound(title)
+    monkeypatch.setitem(dash, "get_worksheet", get_worksheet)
+    monkeypatch.setitem(dash, "get_google_sheet_client", lambda: object())
+    dash["invalidate_results_mirror"]("Results")
+
+    remote = dash["SheetsBackend"]()
+    m = mirror(dash, remote, tmp_path)
+    assert len(m.read_results_raw()) == 4
+    calls = counting(remote)
+    m.pull()
+    assert calls == []
+
+    sheet.data.append(["E", "5", "", "", "2024-03-01", ""])
+    m.pull()
+    assert calls == [["2024-03-01"]]
+    assert sorted(m.read_results_raw()["Marker"]) == ["A", "B", "C", "D", "E"]
+
+
+def test_storage_defaults_to_sheets(dash, monkeypatch):
+    monkeypatch.delenv("HEALTHOS_STORAGE", raising=False)
+    dash["get_storage"].clear()
+    try:
+        assert dash["get_storage"]().name == "sheets"
+    finally:
+        dash["get_storage"].clear()
+
+
+class FakeIndexSheet:
+    """Enough of a worksheet to replay index writes and see every intermediate state."""
+    def __init__(self, rows): self.rows, self.states = [list(r) for r in rows], []
+    def get_all_values(self): return [list(r) for r in self.rows]
+    def clear(self): self.rows = []; self.states.append(self.get_all_values())
+    def update(self, values, range_name="A1"):
+        assert range_name == "A1"
+        self.rows[:len(values)] = [list(map(str, r)) for r in values]
+        self.states.append(self.get_all_values())
+    def batch_clear(self, ranges):
+        (a1,) = ranges
+        start = int(re.match(r"A(\d+):C$", a1).group(1))
+        self.rows = self.rows[:start - 1]
+        self.states.append(self.get_all_values())
+
+
+@pytest.mark.parametrize("dates", [["2024-01-01"], ["2024-01-01", "2024-02-01", "2024-03-01", "2024-04-01"], []])
+def test_index_is_rewritten_without_an_empty_window(dash, dates):
+    columns = dash["INDEX_COLUMNS"]
+    ws = FakeIndexSheet([columns, ["2023-05-01", "Results 2023", "4"], ["2024-01-01", "Results 2024", "2"]])
+    backend = dash["SheetsBackend"]()
+    backend._write_index(ws, {d: (f"Results {d[:4]}", 3) for d in dates})
+    assert backend._index_rows(ws) == {d: (f"Results {d[:4]}", 3) for d in dates}
+    # A concurrent reader (a page load, another process's pull) always finds the header and, while dates exist, rows
+    assert all(state[:1] == [columns] and (len(state) > 1 or not dates) for state in ws.states)
@@ -0,0 +1,81 @@
+"""
+Page dedupe and scan downsampling over a small sample set of generated report pages. Each sample records
+how many pages the old byte-identical rule and the decoded-pixel rule keep.
+"""
+import hashlib
+import io
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+ImageDraw = pytest.importorskip("PIL.ImageDraw")
+pypdf = pytest.importorskip("pypdf")
+from pypdf.generic import NameObject, NumberObject
+
+
+def report_image(value, size=(1240, 1754), noise=0):
+    img = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(img)
+    draw.text((100, 100), "HealthOS Lab - Lipid panel", fill=0)
+    for i, (marker, unit) in enumerate([("Total Cholesterol", "mmol/L"), ("LDL Cholesterol", "mmol/L"), ("HDL", "mmol/L")]):
+        draw.text((100, 200 + 40 * i), f"{marker:<24}{value + i:.1f} {unit}", fill=0)
+    if noise:
+        for x in range(0, size[0], 97): img.putpixel((x, size[1] - 1 - noise), 0)
+    return img
+
+
+def pdf(img, resolution=150.0):
+    buf = io.BytesIO()
+    img.save(buf, format="PDF", resolution=resolution)
+    return buf.getvalue()
+
+
+def rewrapped(page):
+    """The same page written by another tool: an extra page key, so different bytes, identical content."""
+    writer = pypdf.PdfWriter(clone_from=pypdf.PdfReader(io.BytesIO(page)))
+    writer.pages[0][NameObject("/Rotate")] = NumberObject(0)
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+A, B = pdf(report_image(4.5)), pdf(report_image(4.8))
+SAMPLES = {
+    # name: (pages, pages the byte rule keeps, pages the decoded-pixel rule keeps)
+    "same page twice": ([A, A], 1, 1),
+    "same page, different wrapper": ([A, rewrapped(A)], 2, 1),
+    "same scan, different DPI tag": ([A, pdf(report_image(4.5), resolution=300.0)], 2, 1),
+    "same template, other values": ([A, B], 2, 2),  # one digit apart: must never merge
+    "rescan with a speck": ([A, pdf(report_image(4.5, noise=3))], 2, 2),  # not caught: near-matching would merge the row above
+    "three pages, one repeated": ([A, B, rewrapped(A)], 3, 2),
+}
+
+
+def byte_unique(pages): return len(dict.fromkeys(hashlib.sha256(p).digest() for p in pages))
+
+
+@pytest.mark.parametrize("name", SAMPLES)
+def test_repeated_pages_are_dropped(dash, name):
+    pages, by_bytes, by_pixels = SAMPLES[name]
+    kept = dash["unique_frames"](pages)
+    assert (byte_unique(pages), len(kept)) == (by_bytes, by_pixels)
+    assert kept[0] is pages[0]  # first occurrence wins, order kept
+
+
+def test_scanned_page_is_downsampled(dash):
+    page = pdf(report_image(4.5, size=(2480, 3508)).convert("RGB"), resolution=300.0)  # A4 at 300 dpi, colour
+    out = dash["preprocess_pdf_page"](page)
+    assert len(out) < len(page)
+    reader = pypdf.PdfReader(io.BytesIO(out))
+    assert len(reader.pages) == 1
+    (img,) = reader.pages[0].images
+    assert max(img.image.size) == pytest.approx(dash["IMAGE_MAX_SIDE"], abs=1)  # 200 dpi over the page's long edge
+    assert img.image.mode == "L"
+    # Reprocessing is stable, so the extraction cache keeps hitting
+    assert dash["preprocess_pdf_page"](page) == out
+
+
+def test_small_or_text_pages_are_left_alone(dash):
+    small = pdf(report_image(4.5, size=(600, 850)), resolution=72.0)
+    assert dash["preprocess_pdf_page"](small) == small
+    assert dash["preprocess_pdf_page"](b"not a pdf") == b"not a pdf"
@@ -0,0 +1,69 @@
+import pytest
+
+
+def apply_requests(sheet, requests):
+    """Play batchUpdate requests against a list of rows (row 1 = header) the way Sheets would."""
+    sheet = [list(r) for r in sheet]
+    for req in requests:
+        if "updateCells" in req:
+            start = req["updateCells"]["start"]["rowIndex"]
+            for i, row in enumerate(req["updateCells"]["rows"]):
+                sheet[start + i] = [c["userEnteredValue"]["stringValue"] for c in row["values"]]
+        elif "deleteDimension" in req:
+            rng = req["deleteDimension"]["range"]
+            del sheet[rng["startIndex"]:rng["endIndex"]]
+        elif "appendCells" in req:
+            sheet += [[c["userEnteredValue"]["stringValue"] for c in row["values"]] for row in req["appendCells"]["rows"]]
+    return sheet
+
+
+def save(dash, sheet, new_rows):
+    dates = [r[1] for r in sheet[1:]]
+    requests, replaced = dash["diff_results_requests"](0, dates, new_rows, {r[1] for r in new_rows})
+    return apply_requests(sheet, requests), requests, replaced
+
+
+def rows(date, *markers):
+    return [[m, date] for m in markers]
+
+
+HEADER = [["Marker", "Date"]]
+
+
+def stored(sheet):
+    return sorted(map(tuple, sheet[1:]))
+
+
+@pytest.mark.parametrize("new", [
+    rows("2024-02-01", "A2", "B2"),                 # same count: overwrite only
+    rows("2024-02-01", "A2"),                       # fewer: overwrite + delete
+    rows("2024-02-01", "A2", "B2", "C2", "D2"),     # more: overwrite + append
+    rows("2024-05-01", "X"),                        # new date: append only
+])
+def test_replaces_exactly_the_saved_dates(dash, new):
+    sheet = HEADER + rows("2024-01-01", "A", "B") + rows("2024-02-01", "A", "B", "C") + rows("2024-03-01", "A")
+    out, _, _ = save(dash, sheet, new)
+    kept = [r for r in sheet[1:] if r[1] != new[0][1]]
+    assert out[0] == HEADER[0]
+    assert stored(out) == sorted(map(tuple, kept + new))
+
+
+def test_interleaved_dates_delete_bottom_up(dash):
+    sheet = HEADER + [["A", "d1"], ["A", "d2"], ["B", "d1"], ["B", "d2"], ["C", "d1"], ["C", "d2"]]
+    out, requests, replaced = save(dash, sheet, rows("d1", "Z"))
+    assert replaced == [2, 4, 6]
+    deletes = [r["deleteDimension"]["range"]["startIndex"] for r in requests if "deleteDimension" in r]
+    assert deletes == sorted(deletes, reverse=True)
+    assert stored(out) == sorted([("A", "d2"), ("B", "d2"), ("C", "d2"), ("Z", "d1")])
+
+
+def test_contiguous_rows_become_one_request(dash):
+    sheet = HEADER + rows("d1", *"ABCDE")
+    _, requests, _ = save(dash, sheet, rows("d1", *"VW"))
+    assert [next(iter(r)) for r in requests] == ["updateCells", "deleteDimension"]
+    assert requests[1]["deleteDimension"]["range"] == {"sheetId": 0, "dimension": "ROWS", "startIndex": 3, "endIndex": 6}
+
+
+def test_nothing_to_replace_or_add(dash):
+    requests, replaced = dash["diff_results_requests"](0, ["d1"], [], {"d2"})
+    assert (requests, replaced) == ([], [])
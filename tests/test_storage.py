@@ -0,0 +1,47 @@
+import pandas as pd
+import pytest
+
+
+def test_backends_must_implement_the_storage_methods(dash):
+    with pytest.raises(TypeError):
+        dash["StorageBackend"]()
+
+    class ReadOnly(dash["StorageBackend"]):
+        def read_master(self): return None
+    with pytest.raises(TypeError):
+        ReadOnly()
+
+
+def test_sqlite_keeps_only_the_date_index(dash, tmp_path):
+    store = dash["SQLiteBackend"](str(tmp_path / "s.db"))
+    names = {r[0] for r in store.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'results'")}
+    assert "results_marker_date" not in names and "results_date" in names
+    plan = " ".join(r[-1] for r in store.conn.execute("EXPLAIN QUERY PLAN SELECT Date, COUNT(*) FROM results GROUP BY Date"))
+    assert "results_date" in plan
+
+
+def test_sqlite_replaces_by_date(dash, tmp_path):
+    store = dash["SQLiteBackend"](str(tmp_path / "s.db"))
+    rows = lambda date, *markers: pd.DataFrame([[m, "1", "", "", date, ""] for m in markers], columns=dash["REQUIRED_COLUMNS"])
+    store.save_results(rows("2024-01-01", "A", "B"))
+    store.save_results(rows("2024-02-01", "A"))
+    store.save_results(rows("2024-01-01", "C"))
+    assert store.read_results_raw()[["Marker", "Date"]].values.tolist() == [["A", "2024-02-01"], ["C", "2024-01-01"]]
+    index = store.read_results_index(None).set_index("Date")["Rows"].to_dict()
+    assert index == {"2024-01-01": 1, "2024-02-01": 1}
+
+
+def test_master_sheet_edits_retire_the_cached_master(dash, tmp_path, monkeypatch):
+    store = dash["SQLiteBackend"](str(tmp_path / "s.db"))
+    monkeypatch.setitem(dash, "get_storage", lambda: store)
+    dash["invalidate_datasets"](*dash["DATASETS"])
+    store.write_master(pd.DataFrame({"Biomarker": ["LDL"], "Fuzzy Match Keywords": ["LDL"], "Unit": ["mmol/L"]}))
+    dash["master_source_checksum"].clear()
+    master, _, _, msg = dash["load_data"]()
+    assert msg == "OK" and master["Unit"].tolist() == ["mmol/L"]
+
+    # Edited behind the app's back (e.g. in the Sheets UI): nothing invalidates "master"
+    store.write_master(pd.DataFrame({"Biomarker": ["LDL"], "Fuzzy Match Keywords": ["LDL"], "Unit": ["mg/dL"]}))
+    assert dash["load_data"]()[0]["Unit"].tolist() == ["mmol/L"]  # within MASTER_CHECK_SECONDS
+    dash["master_source_checksum"].clear()  # the check interval has passed
+    assert dash["load_data"]()[0]["Unit"].tolist() == ["mg/dL"]
@@ -0,0 +1,54 @@
+import pandas as pd
+import pytest
+
+MASTER = pd.DataFrame({"Biomarker": ["Triglycerides", "LDL Cholesterol", "HDL Cholesterol", "Neutrophils", "Vitamin D"],
+                       "Fuzzy Match Keywords": ["Triglycerides,TRIG", "LDL,LDL Cholesterol", "HDL", "Neutrophils", "Vitamin D,25-OH Vitamin D"]})
+
+REPORT = """City Lab Services
+Patient: J. Doe   DOB: 12/05/1980   Collected: 01/03/2024
+Test                Result   Units    Reference
+Triglycerides  H    2.3      mmol/L   0.0 - 1.7
+LDL Cholesterol     4.2      mmol/L   0.0 - 3.0   H
+HDL Cholesterol     0.8  L   mmol/L   > 1.0
+Neutrophils         55 %     4.50     10^9/L   2.0 - 7.5
+Vitamin D           75       nmol/L   50 - 150
+Page 1 of 1
+"""
+
+
+@pytest.fixture
+def rows(dash):
+    df = dash["parse_text_layer"](REPORT, dash["text_layer_keywords"](MASTER))
+    return {r.Marker: (r.Value, r.Unit, r.Flag) for r in df.itertuples()}
+
+
+def test_values_and_units(rows):
+    assert rows["LDL Cholesterol"][:2] == ("4.2", "mmol/L")
+    assert rows["Neutrophils"][:2] == ("4.50", "10^9/L")  # the absolute count, not the percentage
+    assert rows["Vitamin D"] == ("75", "nmol/L", "")
+    assert set(rows) == {"Triglycerides", "LDL Cholesterol", "HDL Cholesterol", "Neutrophils", "Vitamin D"}
+
+
+def test_flag_before_the_value_is_not_part_of_the_name(rows):
+    assert rows["Triglycerides"] == ("2.3", "mmol/L", "H")
+
+
+def test_flag_after_the_value_or_the_range(rows):
+    assert rows["HDL Cholesterol"] == ("0.8", "mmol/L", "L")
+    assert rows["LDL Cholesterol"][2] == "H"
+
+
+@pytest.mark.parametrize("text, date", [
+    ("Patient: J. Doe   DOB: 12/05/1980   Collected: 01/03/2024", "2024-03-01"),
+    ("Date of Birth 12 May 1980, Report date 2024-03-05", "2024-03-05"),
+    ("DOB 12/05/1980\nSample received 14 Feb 2024", "2024-02-14"),
+    ("Born 1980-05-12\n", None),
+    ("Printed 2024-04-01\nCollection date: 02/03/2024", "2024-03-02"),  # a line naming the date wins
+])
+def test_report_date(dash, text, date):
+    assert dash["find_report_date"](text) == date
+
+
+def test_whole_report(dash):
+    df = dash["parse_result_table"](REPORT, MASTER)
+    assert (df["Date"] == "2024-03-01").all() and len(df) == 5
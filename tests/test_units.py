@@ -0,0 +1,65 @@
+import pandas as pd
+import pytest
+
+from lab_units import UNIT_CONVERSIONS, canonicalize, extract_unit, normalize_unit, parse_value
+
+MASTER = pd.DataFrame({
+    "Biomarker": ["Total Cholesterol", "HbA1c", "Fasting Insulin", "Vitamin D", "White Cell Count", "Sodium"],
+    "Fuzzy Match Keywords": ["Total Cholesterol,Cholesterol", "HbA1c,Glycated", "Fasting Insulin,Insulin", "Vitamin D,25-OH Vitamin D", "White Cell Count,WCC", "Sodium"],
+    "Unit": ["mg/dL", "%", "uIU/mL", "ng/mL", "10^9/L", "mmol/L"],
+})
+
+ROWS = pd.DataFrame({
+    "Marker": ["Cholesterol", "HbA1c", "HbA1c", "Insulin", "25-OH Vitamin D", "WCC", "Sodium", "Mystery"],
+    "Value": ["6.1", "38", "5.6", "60", "75 nmol/L", "6.2", "<130", "12"],
+    "Unit": ["mmol/L", "", "%", "pmol/L", "", "K/uL", "mmol/L", "mg/L"],
+})
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("5.4", 5.4), ("1,200", 1200.0), ("<0.5", 0.5), (">90", 90.0), ("38 mmol/mol", 38.0), ("", None), (None, None), ("neg", None),
+])
+def test_parse_value(raw, expected):
+    assert parse_value(raw) == expected
+
+
+def test_units_read_off_the_value_cell():
+    assert extract_unit("75 nmol/L") == "nmol/L"
+    assert extract_unit("6.2") == ""
+
+
+def test_equivalent_spellings_fold_together():
+    assert normalize_unit("K/uL") == normalize_unit("x10^9/L") == normalize_unit("10^9/l")
+    assert normalize_unit("µg/L") == normalize_unit("ng/mL")
+
+
+def test_round_trips_are_inverse():
+    for (b, f, t), (factor, offset) in UNIT_CONVERSIONS.items():
+        back = UNIT_CONVERSIONS.get((b, t, f))
+        if back is None:
+            continue
+        x = 50.0
+        assert (x * factor + offset) * back[0] + back[1] == pytest.approx(x, rel=0.01), (b, f, t)
+
+
+def test_canonicalize():
+    biomarker = pd.Series(["Total Cholesterol", "HbA1c", "HbA1c", "Fasting Insulin", "Vitamin D", "White Cell Count", "Sodium", None])
+    target = pd.Series(["mg/dL", "%", "%", "uIU/mL", "ng/mL", "10^9/L", "mmol/L", None])
+    value, unit = canonicalize(ROWS["Value"], ROWS["Unit"], biomarker, target)
+    assert value[0] == pytest.approx(235.9, abs=0.1)
+    assert unit[0] == "mg/dL"
+    assert value[1] == pytest.approx(5.63, abs=0.01)  # unitless IFCC HbA1c is read as mmol/mol
+    assert value[2] == 5.6
+    assert value[3] == pytest.approx(8.64)
+    assert value[4] == pytest.approx(30.05, abs=0.01)  # unit taken from the value cell
+    assert (value[5], unit[5]) == (6.2, "10^9/L")
+    assert (value[6], unit[6]) == (130.0, "mmol/L")
+    assert (value[7], unit[7]) == (12.0, "mg/L")  # unmatched rows keep their own number and unit
+
+
+def test_both_apps_convert_a_row_the_same_way(dash, clinical):
+    master = dash["normalize_master"](MASTER.copy())
+    d = dash["apply_unit_conversions"](ROWS.copy(), master)
+    c = clinical["apply_unit_conversions"](ROWS.copy(), MASTER.copy())
+    pd.testing.assert_series_equal(d["NumericValue"], c["CanonicalValue"], check_names=False)
+    pd.testing.assert_series_equal(d["CanonicalUnit"], c["CanonicalUnit"], check_names=False)
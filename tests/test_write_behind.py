@@ -0,0 +1,68 @@
+import pandas as pd
+import pytest
+
+
+class RecordingStore:
+    def __init__(self): self.calls = []
+    def save_results(self, df): self.calls.append(("save_results", sorted(map(tuple, df[["Marker", "Date"]].values.tolist()))))
+    def clear_results(self): self.calls.append(("clear_results",))
+    def save_profile(self, profile): self.calls.append(("save_profile", profile))
+    def reset(self): pass
+
+
+@pytest.fixture
+def queue(dash, tmp_path, monkeypatch):
+    monkeypatch.setitem(dash, "WRITE_BATCH_SECONDS", 3600)  # the worker never gets to flush; tests call flush()
+    return dash["WriteBehind"](RecordingStore(), str(tmp_path / "queue.db"))
+
+
+def row(marker, date): return [marker, "1", "", "", date, ""]
+
+
+def test_one_entry_per_date_last_write_wins(queue):
+    queue.enqueue([("results:d1", [row("A", "d1")]), ("results:d2", [row("B", "d2")])])
+    queue.enqueue([("results:d1", [row("C", "d1"), row("D", "d1")])])
+    assert [k for _, k, _ in queue.pending()] == ["results:d2", "results:d1"]
+    queue.flush()
+    assert queue.store.calls == [("save_results", [("B", "d2"), ("C", "d1"), ("D", "d1")])]
+    assert queue.pending() == []
+
+
+def test_clear_drops_earlier_results_but_not_later_ones(queue):
+    queue.enqueue([("results:d1", [row("A", "d1")]), ("profile", {"Age": "40"})])
+    queue.enqueue([("results:clear", None)])
+    queue.enqueue([("results:d2", [row("B", "d2")])])
+    assert [k for _, k, _ in queue.pending()] == ["profile", "results:clear", "results:d2"]
+    queue.flush()
+    assert queue.store.calls == [("clear_results",), ("save_results", [("B", "d2")]), ("save_profile", {"Age": "40"})]
+
+
+def test_profile_keeps_only_the_latest(queue):
+    queue.enqueue([("profile", {"Age": "40"})])
+    queue.enqueue([("profile", {"Age": "41"})])
+    assert queue.overlay_profile({}) == {"Age": "41"}
+    queue.flush()
+    assert queue.store.calls == [("save_profile", {"Age": "41"})]
+
+
+def test_failed_flush_keeps_the_batch(queue):
+    def fail(df): raise RuntimeError("offline")
+    queue.store.save_results = fail
+    queue.enqueue([("results:d1", [row("A", "d1")])])
+    with pytest.raises(RuntimeError):
+        queue.flush()
+    assert [k for _, k, _ in queue.pending()] == ["results:d1"]
+
+
+def test_queue_survives_a_restart(dash, queue, tmp_path):
+    queue.enqueue([("results:d1", [row("A", "d1")])])
+    again = dash["WriteBehind"](RecordingStore(), str(tmp_path / "queue.db"))
+    assert [k for _, k, _ in again.pending()] == ["results:d1"]
+
+
+def test_overlay_index_shows_queued_dates(dash, queue):
+    index = pd.DataFrame([["d1", "Results d1", 3], ["d2", "Results d2", 1]], columns=dash["INDEX_COLUMNS"])
+    queue.enqueue([("results:d1", [row("A", "d1")])])
+    assert queue.overlay_index(index).set_index("Date")["Rows"].to_dict() == {"d1": 1, "d2": 1}
+    queue.enqueue([("results:clear", None)])
+    assert queue.overlay_index(index).empty